@@ -1,101 +1,204 @@
-import librosa
-import soundfile as sf
+import hashlib
+from typing import Iterator, Literal
+
+import numpy as np
 
 from utils import StreamUtils
-from google import genai
-from google.genai import types
 from dotenv import load_dotenv
 
 from structures import Chorus
+from features import FeatureExtractor
+from cache import FeatureCache, JsonCache
+from prompt import FeaturePromptEncoder
+from chorus import ChorusDetector
 from logger import MyLogger
+from tracing import Tracer
 
 load_dotenv()
 
 
 class SoundAnalyzer:
-    def __init__(self, path: str):
+    STREAM_BLOCK_SECONDS: int = 10  # Seconds of audio decoded per block when streaming
+    LLM_MODEL: str = "gemini-2.5-flash"
+    PROMPT_VERSION: str = "2"  # Bump when the prompt changes to invalidate responses
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: int | None = None,
+        streaming: bool = False,
+        workers: int = 1,
+        cache: FeatureCache | None = None,
+        response_cache: JsonCache | None = None,
+        prompt_encoder: FeaturePromptEncoder | None = None,
+    ):
+        """
+        :param path: Path to the audio or video file to analyze
+        :param sample_rate: Sample rate to decode at, defaults to the source rate
+        :param streaming: Decode and analyze block by block with bounded memory,
+            for very long audio such as live sets and DJ mixes
+        :param workers: Number of processes extracting features in parallel
+        :param cache: Cache consulted before extracting features
+        :param response_cache: Cache of LLM chorus responses
+        :param prompt_encoder: Encoder of the features sent to the LLM
+        """
+        if streaming and workers > 1:
+            raise ValueError("Streaming analysis runs in a single process.")
         self.path = path
-        if not path.endswith(".wav"):
-            self.path = StreamUtils.convert_to_wav(path)
+        self.sample_rate = sample_rate
+        self.streaming = streaming
+        self.workers = workers
+        self.cache = cache
+        self.response_cache = response_cache
+        self.prompt_encoder = prompt_encoder or FeaturePromptEncoder()
         self.logger = MyLogger.get_logger("SoundAnalyzer")
+        self._signal: tuple[np.ndarray, int] | None = None
+
+    def _get_signal(self) -> tuple[np.ndarray, int]:
+        """
+        Decode the audio to a mono float32 array, once per analyzer.
+        """
+        if self._signal is None:
+            self._signal = StreamUtils.decode_audio(self.path, self.sample_rate)
+        return self._signal
+
+    def _stream_blocks(self, sr: int) -> Iterator[np.ndarray]:
+        return StreamUtils.stream_audio(
+            self.path, block_size=sr * self.STREAM_BLOCK_SECONDS, sample_rate=sr
+        )
 
+    def iter_features(self) -> Iterator[dict]:
+        """
+        Generate the per-second features of the audio.
+        In streaming mode the signal is never held in memory as a whole.
+        """
+        if not self.streaming:
+            y, sr = self._get_signal()
+            # 1 sec = sr samples, the last partial second is skipped
+            yield from FeatureExtractor(sr).extract_parallel(y, self.workers)
+            return
+
+        sr = self.sample_rate or StreamUtils.get_audio_sample_rate(self.path)
+        yield from FeatureExtractor(sr).extract_stream(self._stream_blocks(sr))
+
+    @Tracer.trace("features")
     def _get_features(self):
-        y, sr = sf.read(self.path, always_2d=False)
-        if y.ndim > 1:
-            y = y.mean(axis=1)  # convert to mono manually if needed
-
-        # Chop into 1-second chunks
-        chunk_size = sr  # 1 sec = 44100 samples
-
-        features = []
-        for i in range(0, len(y), chunk_size):
-            y_chunk = y[i : i + chunk_size]
-
-            if len(y_chunk) < chunk_size:
-                break  # skip last partial second
-
-            # ── Extract features (non-deprecated, preferred usage)
-            chroma = librosa.feature.chroma_stft(y=y_chunk, sr=sr).mean(
-                axis=1
-            )  # shape: (12,)
-            mfccs = librosa.feature.mfcc(y=y_chunk, sr=sr, n_mfcc=13).mean(
-                axis=1
-            )  # shape: (13,)
-            zcr = librosa.feature.zero_crossing_rate(y_chunk).mean()  # scalar
-            rms = librosa.feature.rms(y=y_chunk).mean()  # scalar
-            f0 = librosa.yin(
-                y_chunk,
-                fmin=float(librosa.note_to_hz("C2")),
-                fmax=float(librosa.note_to_hz("C7")),
-                sr=sr,
-            ).mean()  # scalar
-
-            features.append(
-                {
-                    "second": i // chunk_size,
-                    "mfcc": mfccs.tolist(),
-                    "chroma": chroma.tolist(),
-                    "zcr": float(zcr),
-                    "rms": float(rms),
-                    "pitch": float(f0),
-                }
+        if self.cache is None:
+            return list(self.iter_features())
+
+        if self.streaming:
+            sr = self.sample_rate or StreamUtils.get_audio_sample_rate(self.path)
+            # Hashing pass over the decoded blocks, memory stays bounded
+            key = self.cache.key(
+                self._stream_blocks(sr), FeatureExtractor(sr).params()
             )
+        else:
+            y, sr = self._get_signal()
+            key = self.cache.key([y], FeatureExtractor(sr).params())
+
+        features = self.cache.get(key)
+        if features is not None:
+            self.logger.info("Audio features loaded from cache.")
+            return features
+
+        features = list(self.iter_features())
+        self.cache.put(key, features)
         return features
 
-    def pick_chorus(self, lyrics_path: str):
+    def pick_chorus(
+        self,
+        lyrics_path: str,
+        mode: Literal["llm", "local", "auto"] = "llm",
+        features: list[dict] | None = None,
+    ):
         """
         This method should analyze the features and return the most likely chorus segment.
+        :param lyrics_path: Path to the SRT lyrics of the song
+        :param mode: "llm" asks Gemini, "local" runs the offline ChorusDetector,
+            "auto" asks Gemini and falls back to the local detector if it is unavailable
+        :param features: Features already extracted from this audio, if any
+        """
+        if features is None:
+            self.logger.info("Extracting audio features...")
+            features = self._get_features()
+            self.logger.info("Audio features extracted successfully.")
+
+        match mode:
+            case "llm":
+                chorus = self._pick_chorus_llm(features, lyrics_path)
+            case "local":
+                chorus = ChorusDetector().detect(features, lyrics_path)
+            case "auto":
+                try:
+                    chorus = self._pick_chorus_llm(features, lyrics_path)
+                except Exception as e:
+                    self.logger.warning(
+                        f"LLM chorus detection unavailable ({e}), using local detector."
+                    )
+                    chorus = ChorusDetector().detect(features, lyrics_path)
+            case _:
+                raise ValueError(f"Unknown chorus detection mode: {mode}")
+
+        return chorus.start_time, chorus.end_time
+
+    def _pick_chorus_llm(self, features: list[dict], lyrics_path: str) -> Chorus:
+        """
+        Ask the LLM for the chorus segment given the features and the lyrics.
         """
-        client = genai.Client()
-
-        self.logger.info("Extracting audio features...")
-        features = self._get_features()
-        self.logger.info("Audio features extracted successfully.")
-
         with open(lyrics_path, "r", encoding="utf-8") as f:
             lyrics = f.read()
         self.logger.info("Lyrics loaded successfully.")
-        self.logger.info("Sending request to LLM for best part detection...")
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                "Here is the audio features extracted from the song:\n\n"
-                + str(features)
-                + "Here are the lyrics of the song: \n\n"
-                + lyrics
-            ],
-            config=types.GenerateContentConfig(
-                temperature=0.0,
-                system_instruction="You are an expert in audio analysis, music productor, and sound engineer. Your task is to analyze the audio features and lyrics to identify the chorus segment of a song.",
-                response_mime_type="application/json",
-                response_schema=Chorus,
-            ),
+
+        encoded_features = self.prompt_encoder.encode(features)
+        self.logger.info(
+            f"Encoded features to ~{self.prompt_encoder.estimate_tokens(encoded_features)} tokens."
         )
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = JsonCache.key(
+                hashlib.sha256(encoded_features.encode("utf-8")).hexdigest(),
+                hashlib.sha256(lyrics.encode("utf-8")).hexdigest(),
+                self.LLM_MODEL,
+                self.PROMPT_VERSION,
+            )
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("LLM response loaded from cache.")
+                return Chorus.model_validate(cached)
+
+        # Imported here so offline jobs do not need google-genai
+        from google import genai
+        from google.genai import types
+
+        client = genai.Client()
+
+        self.logger.info("Sending request to LLM for best part detection...")
+        with Tracer.span(
+            "llm", "llm", model=self.LLM_MODEL, prompt_chars=len(encoded_features)
+        ):
+            response = client.models.generate_content(
+                model=self.LLM_MODEL,
+                contents=[
+                    "Here is the audio features extracted from the song:\n\n"
+                    + encoded_features
+                    + "\n\nHere are the lyrics of the song: \n\n"
+                    + lyrics
+                ],
+                config=types.GenerateContentConfig(
+                    temperature=0.0,
+                    system_instruction="You are an expert in audio analysis, music productor, and sound engineer. Your task is to analyze the audio features and lyrics to identify the chorus segment of a song.",
+                    response_mime_type="application/json",
+                    response_schema=Chorus,
+                ),
+            )
         self.logger.info("LLM response received.")
         llm_response = response.parsed
         assert isinstance(llm_response, Chorus), "LLM response is not of type Chorus"
 
-        return llm_response.start_time, llm_response.end_time
+        if cache_key is not None:
+            self.response_cache.put(cache_key, llm_response.model_dump())
+        return llm_response
 
 
 def _test():
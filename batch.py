@@ -0,0 +1,328 @@
+import os
+import csv
+import json
+import queue
+import argparse
+import threading
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from logger import MyLogger
+from structures import UserPrompts, ENCODER_PROFILES, OUTPUT_FORMATS
+from media_source import LocalSource
+from pipeline import Pipeline
+from tracing import Tracer
+from metrics import Metrics, JsonlMetricsSink
+
+load_dotenv()
+
+
+class SongJob(BaseModel):
+    """
+    Represents one song of a batch and what each stage produced for it.
+    """
+
+    index: int  # Position in the manifest
+    prompt: UserPrompts
+    entry: dict | None = None
+    file_name: str | None = None
+    subtitle_file: str | None = None
+    metadata: dict | None = None
+    features: list[dict] | None = None
+    chorus: tuple[float, float] | None = None
+    video_file: str | None = None  # Rendered video, the chorus with segment downloads
+    source_offset: float = 0.0
+    output_path: str | None = None
+    error: str | None = None  # "<stage>: <message>" if the job failed
+
+
+def read_manifest(path: str) -> list[UserPrompts]:
+    """
+    Read the songs of a JSONL or CSV manifest with title, author and language fields.
+    The language defaults to the LANGUAGE environment variable, then "en".
+    """
+    default_language = os.getenv("LANGUAGE", "en")
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    return [
+        UserPrompts(
+            title=row["title"],
+            author=row["author"],
+            language=row.get("language") or default_language,
+        )
+        for row in rows
+    ]
+
+
+class BatchRunner:
+    """
+    Runs many songs through the pipeline stages concurrently.
+
+    Every stage has its own bounded input queue and worker threads, so network-bound
+    stages (search, download, chorus, segment) overlap with CPU-bound ones (analyze, render)
+    while the queues keep finished work from piling up ahead of a slow stage.
+    """
+
+    STAGES: tuple[str, ...] = (
+        "search",
+        "download",
+        "analyze",
+        "chorus",
+        "segment",
+        "render",
+    )
+    DEFAULT_CONCURRENCY: dict[str, int] = {
+        "search": 4,
+        "download": 4,
+        "analyze": 1,
+        "chorus": 4,
+        "segment": 4,  # Downloads the chorus of the video with segment downloads
+        "render": 1,
+    }
+    QUEUE_SIZE: int = 4
+
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        concurrency: dict[str, int] | None = None,
+        queue_size: int = QUEUE_SIZE,
+    ):
+        """
+        :param concurrency: Worker threads per stage, missing stages use the defaults
+        :param queue_size: Capacity of each stage's input queue
+        """
+        self.pipeline = pipeline
+        self.concurrency = {**self.DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self.queue_size = queue_size
+        self.logger = MyLogger.get_logger("batch")
+
+    def _run_stage(self, stage: str, job: SongJob):
+        match stage:
+            case "search":
+                job.entry = self.pipeline.search(job.prompt)
+            case "download":
+                assert job.entry is not None
+                job.file_name, job.subtitle_file, job.metadata = (
+                    self.pipeline.download(job.prompt, job.entry)
+                )
+            case "analyze":
+                assert job.file_name is not None
+                job.features = self.pipeline.analyze(job.file_name)
+            case "chorus":
+                assert job.file_name is not None and job.subtitle_file is not None
+                job.chorus = self.pipeline.choose_chorus(
+                    job.file_name, job.subtitle_file, job.features
+                )
+            case "segment":
+                assert job.file_name is not None and job.chorus is not None
+                job.video_file, job.source_offset = self.pipeline.render_source(
+                    job.file_name, job.metadata, job.chorus
+                )
+            case "render":
+                assert (
+                    job.video_file is not None
+                    and job.subtitle_file is not None
+                    and job.metadata is not None
+                    and job.chorus is not None
+                )
+                job.output_path = self.pipeline.render(
+                    job.prompt,
+                    job.video_file,
+                    job.subtitle_file,
+                    job.metadata,
+                    job.chorus,
+                    source_offset=job.source_offset,
+                )
+                job.features = None  # Not needed anymore
+
+    def run(self, prompts: list[UserPrompts]) -> list[SongJob]:
+        """
+        Run every song through every stage.
+        :return: One job per song in manifest order, failed ones have an error
+        """
+        jobs = [SongJob(index=i, prompt=prompt) for i, prompt in enumerate(prompts)]
+        queues: list[queue.Queue[SongJob | None]] = [
+            queue.Queue(maxsize=self.queue_size) for _ in self.STAGES
+        ]
+        finished_workers = [0] * len(self.STAGES)
+        lock = threading.Lock()
+
+        def worker(i: int):
+            stage = self.STAGES[i]
+            while True:
+                job = queues[i].get()
+                if job is None:
+                    # The last worker of a stage to stop shuts the next stage down
+                    with lock:
+                        finished_workers[i] += 1
+                        last = finished_workers[i] == self.concurrency[stage]
+                    if last and i + 1 < len(self.STAGES):
+                        for _ in range(self.concurrency[self.STAGES[i + 1]]):
+                            queues[i + 1].put(None)
+                    return
+
+                self.logger.info(
+                    f"[{job.index}] {stage}: {job.prompt.title} by {job.prompt.author}"
+                )
+                try:
+                    with Tracer.span(
+                        f"{stage} #{job.index}", "job", job=job.index, title=job.prompt.title
+                    ):
+                        self._run_stage(stage, job)
+                except Exception as e:
+                    job.error = f"{stage}: {e}"
+                    self.logger.error(f"[{job.index}] Failed at {job.error}")
+                    continue
+                if i + 1 < len(self.STAGES):
+                    queues[i + 1].put(job)
+
+        threads = [
+            threading.Thread(target=worker, args=(i,), name=f"{stage}-{n}", daemon=True)
+            for i, stage in enumerate(self.STAGES)
+            for n in range(self.concurrency[stage])
+        ]
+        for thread in threads:
+            thread.start()
+
+        for job in jobs:
+            queues[0].put(job)
+        for _ in range(self.concurrency[self.STAGES[0]]):
+            queues[0].put(None)
+
+        for thread in threads:
+            thread.join()
+
+        failed = sum(job.error is not None for job in jobs)
+        self.logger.info(f"Batch finished: {len(jobs) - failed} rendered, {failed} failed.")
+        return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render lyric videos for every song of a JSONL or CSV manifest."
+    )
+    parser.add_argument("manifest", help="Manifest with title, author, language")
+    for stage in BatchRunner.STAGES:
+        parser.add_argument(
+            f"--{stage}-workers",
+            type=int,
+            default=BatchRunner.DEFAULT_CONCURRENCY[stage],
+            help=f"Concurrent {stage} jobs",
+        )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=BatchRunner.QUEUE_SIZE,
+        help="Capacity of each stage queue",
+    )
+    parser.add_argument(
+        "--analysis-processes",
+        type=int,
+        default=int(os.getenv("ANALYSIS_WORKERS", "1")),
+        help="Processes used by each feature extraction",
+    )
+    parser.add_argument(
+        "--chorus-mode",
+        choices=["llm", "local", "auto"],
+        default=os.getenv("CHORUS_MODE", "auto"),
+    )
+    parser.add_argument(
+        "--search-results",
+        type=int,
+        default=int(os.getenv("SEARCH_RESULTS", "5")),
+        help="Search results ranked per song",
+    )
+    parser.add_argument(
+        "--segment-download",
+        action="store_true",
+        default=os.getenv("SEGMENT_DOWNLOAD", "").lower() in ("1", "true"),
+        help="Download the audio first, then only the chorus of the video",
+    )
+    parser.add_argument(
+        "--media-dir",
+        default=os.getenv("MEDIA_DIR"),
+        help="Serve songs from this directory instead of YouTube",
+    )
+    parser.add_argument(
+        "--render-chunks",
+        type=int,
+        default=int(os.getenv("RENDER_CHUNKS", "1")),
+        help="Chunks of each render encoded in parallel",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(ENCODER_PROFILES),
+        default=os.getenv("ENCODER_PROFILE", "standard"),
+        help="Encoder profile, draft renders a quick downscaled preview",
+    )
+    parser.add_argument(
+        "--formats",
+        choices=list(OUTPUT_FORMATS),
+        nargs="+",
+        default=os.getenv("OUTPUT_FORMATS", "").split() or None,
+        help="Render these aspect ratios from one decode, e.g. 9:16 1:1 16:9",
+    )
+    parser.add_argument(
+        "--fit",
+        choices=["crop", "pad"],
+        default=os.getenv("OUTPUT_FIT", "crop"),
+        help="Crop the video to fill the formats, or pad it to fit",
+    )
+    parser.add_argument(
+        "--trace",
+        default=os.getenv("TRACE_FILE"),
+        help="Write the spans of the run, JSON lines if the path ends with .jsonl, "
+        "Chrome trace otherwise",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=os.getenv("METRICS_FILE"),
+        help="Append the cost of every effect application to this JSONL file",
+    )
+    parser.add_argument("--results", help="Write one JSON result per song to this file")
+    args = parser.parse_args()
+
+    if args.metrics:
+        Metrics.add_sink(JsonlMetricsSink(args.metrics))
+
+    runner = BatchRunner(
+        Pipeline(
+            analysis_workers=args.analysis_processes,
+            chorus_mode=args.chorus_mode,
+            search_results=args.search_results,
+            segment_download=args.segment_download,
+            source=LocalSource(args.media_dir) if args.media_dir else None,
+            render_chunks=args.render_chunks,
+            encoder_profile=args.profile,
+            output_formats=args.formats,
+            output_fit=args.fit,
+        ),
+        concurrency={
+            stage: getattr(args, f"{stage}_workers") for stage in BatchRunner.STAGES
+        },
+        queue_size=args.queue_size,
+    )
+    try:
+        jobs = runner.run(read_manifest(args.manifest))
+    finally:
+        if args.trace:
+            Tracer.export(args.trace)
+        if Metrics.AGGREGATOR.summary():
+            runner.logger.info(f"Effect costs:\n{Metrics.summary_json()}")
+
+    if args.results:
+        with open(args.results, "w", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(
+                    job.model_dump_json(include={"index", "prompt", "output_path", "error"})
+                    + "\n"
+                )
+
+
+if __name__ == "__main__":
+    main()
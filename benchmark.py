@@ -0,0 +1,393 @@
+"""
+End-to-end benchmark on synthetic media generated with ffmpeg lavfi sources.
+
+Every case renders a color bars video with a tone or music-like soundtrack and an
+SRT with the requested cue density, then times each stage on it separately.
+Results are written as JSON and can be compared with a stored baseline:
+
+    python benchmark.py --durations 60 240 --resolutions 640x360 1920x1080
+    python benchmark.py --baseline bench_baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+from typing import Callable, Literal
+
+import ffmpeg
+from pydantic import BaseModel
+
+from logger import MyLogger
+from structures import UserPrompts, ENCODER_PROFILES
+from utils import StreamUtils
+from metrics import Metrics
+
+STAGES: tuple[str, ...] = (
+    "wav_conversion",
+    "features",
+    "chorus",
+    "render",
+)
+# The effects applied then the subtitles burned in a second pass, only timed to
+# compare with the single-pass render
+MULTI_PASS_STAGES: tuple[str, ...] = ("apply_effects", "add_subtitles")
+
+
+class BenchmarkCase(BaseModel):
+    """
+    Parameters of one synthetic song.
+    """
+
+    track_seconds: float = 60
+    width: int = 1280
+    height: int = 720
+    fps: int = 25
+    audio: Literal["tone", "music"] = "music"
+    cues_per_minute: float = 20  # Subtitle density
+    cue_seconds: float = 2.5  # How long each cue stays on screen
+    cue_chars: int = 32  # Length of each cue text
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.audio}-{self.track_seconds:g}s-{self.width}x{self.height}"
+            f"-{self.cues_per_minute:g}cpm"
+        )
+
+    @property
+    def cue_count(self) -> int:
+        return int(self.track_seconds * self.cues_per_minute / 60)
+
+
+class BenchmarkEngine(BaseModel):
+    """
+    Implementation choices under test, so engines can be compared on the same media.
+    """
+
+    subtitle_renderer: Literal["ass", "drawtext"] = "ass"
+    analysis_workers: int = 1
+    streaming: bool = False
+    encoder_profile: str = "standard"
+    multi_pass: bool = False  # Also time the multi-pass stages
+
+    @property
+    def stages(self) -> tuple[str, ...]:
+        return STAGES + MULTI_PASS_STAGES if self.multi_pass else STAGES
+
+
+class BenchmarkResult(BaseModel):
+    case: BenchmarkCase
+    engine: BenchmarkEngine
+    cue_count: int
+    timings: dict[str, float]  # Median seconds per stage
+    runs: dict[str, list[float]]  # Seconds of every repetition per stage
+
+
+class MediaFixtures:
+    """
+    Generates the synthetic media of the benchmark cases.
+    """
+
+    # Four bar sections, the chorus (section 1) comes back every other section,
+    # with a beat on every half second so the features see rhythm and repetition
+    MUSIC_EXPR: str = (
+        "0.4*sin(2*PI*t*(220+55*mod(floor(t/8),2)*(1+mod(floor(t/16),2))))"
+        "*(0.6+0.4*lt(mod(t,0.5),0.1))"
+        "+0.2*sin(2*PI*t*330*(1+0.5*mod(floor(t/8),2)))"
+    )
+
+    @staticmethod
+    def audio_source(case: BenchmarkCase):
+        if case.audio == "tone":
+            return ffmpeg.input(
+                f"sine=frequency=440:sample_rate=44100:duration={case.track_seconds}",
+                f="lavfi",
+            )
+        return ffmpeg.input(
+            f"aevalsrc='{MediaFixtures.MUSIC_EXPR}':s=44100:d={case.track_seconds}",
+            f="lavfi",
+        )
+
+    @staticmethod
+    def video(case: BenchmarkCase, output_path: str) -> str:
+        """
+        Render the color bars video with its soundtrack.
+        """
+        video = ffmpeg.input(
+            f"smptebars=size={case.width}x{case.height}:rate={case.fps}"
+            f":duration={case.track_seconds}",
+            f="lavfi",
+        )
+        (
+            ffmpeg.output(
+                video,
+                MediaFixtures.audio_source(case),
+                output_path,
+                vcodec="libx264",
+                acodec="aac",
+                pix_fmt="yuv420p",
+                preset="ultrafast",
+                shortest=None,
+            )
+            .overwrite_output()
+            .global_args("-hide_banner", "-loglevel", "error")
+            .run()
+        )
+        return output_path
+
+    @staticmethod
+    def _srt_time(seconds: float) -> str:
+        millis = round(seconds * 1000)
+        hours, millis = divmod(millis, 3_600_000)
+        minutes, millis = divmod(millis, 60_000)
+        secs, millis = divmod(millis, 1000)
+        return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+
+    @staticmethod
+    def subtitles(case: BenchmarkCase, output_path: str) -> str:
+        """
+        Write cues spread evenly over the track.
+        """
+        interval = 60 / case.cues_per_minute
+        words = "never gonna give you up let you down run around and desert".split()
+        with open(output_path, "w", encoding="utf-8") as f:
+            for i in range(case.cue_count):
+                start = i * interval
+                end = min(start + case.cue_seconds, case.track_seconds)
+                text = ""
+                while len(text) < case.cue_chars:
+                    text += words[(i + len(text)) % len(words)] + " "
+                f.write(
+                    f"{i + 1}\n{MediaFixtures._srt_time(start)} --> "
+                    f"{MediaFixtures._srt_time(end)}\n{text[: case.cue_chars].strip()}\n\n"
+                )
+        return output_path
+
+
+class BenchmarkRunner:
+    """
+    Times every stage of the pipeline on synthetic media.
+    """
+
+    CHORUS_SECONDS: float = 20  # Length of the segment rendered by the render stages
+
+    def __init__(self, work_dir: str, repeat: int = 3):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.logger = MyLogger.get_logger("benchmark")
+
+    def _time(self, func: Callable[[], object]) -> tuple[float, object]:
+        start = time.perf_counter()
+        result = func()
+        return time.perf_counter() - start, result
+
+    def run_case(self, case: BenchmarkCase, engine: BenchmarkEngine) -> BenchmarkResult:
+        # Imported here so the fixtures can be generated without the analysis stack
+        from analyzer import SoundAnalyzer
+        from effects import EditorEffects
+
+        case_dir = os.path.join(self.work_dir, case.name)
+        os.makedirs(case_dir, exist_ok=True)
+        video_path = os.path.join(case_dir, "source.mp4")
+        subtitle_path = os.path.join(case_dir, "source.en.srt")
+        if not os.path.exists(video_path):
+            self.logger.info(f"Generating {case.name}...")
+            MediaFixtures.video(case, video_path)
+        MediaFixtures.subtitles(case, subtitle_path)
+
+        runs: dict[str, list[float]] = {stage: [] for stage in engine.stages}
+        prompt = UserPrompts(title="Benchmark", author="lavfi", language="en")
+        for _ in range(self.repeat):
+            StreamUtils.invalidate(video_path)
+            elapsed, wav_path = self._time(lambda: StreamUtils.convert_to_wav(video_path))
+            runs["wav_conversion"].append(elapsed)
+            os.remove(wav_path)
+
+            analyzer = SoundAnalyzer(
+                video_path, streaming=engine.streaming, workers=engine.analysis_workers
+            )
+            elapsed, features = self._time(analyzer._get_features)
+            runs["features"].append(elapsed)
+
+            elapsed, chorus = self._time(
+                lambda: analyzer.pick_chorus(subtitle_path, mode="local", features=features)
+            )
+            runs["chorus"].append(elapsed)
+
+            start_time = chorus[0]
+            duration = min(self.CHORUS_SECONDS, case.track_seconds - start_time)
+            edited_path = os.path.join(case_dir, "edited.mp4")
+            editor = EditorEffects(
+                file_path=edited_path,
+                subtitle_path=subtitle_path,
+                start_time=start_time,
+                duration=duration,
+                subtitle_renderer=engine.subtitle_renderer,
+                profile=engine.encoder_profile,
+            )
+            # The path the pipeline renders with
+            elapsed, _ = self._time(lambda: editor.render_vid(video_path, prompt))
+            runs["render"].append(elapsed)
+            os.remove(edited_path)
+
+            if engine.multi_pass:
+                shutil.copyfile(video_path, edited_path)
+                elapsed, _ = self._time(
+                    lambda: editor.apply_effects(editor.vid_effects(prompt))
+                )
+                runs["apply_effects"].append(elapsed)
+
+                elapsed, _ = self._time(editor.add_subtitles)
+                runs["add_subtitles"].append(elapsed)
+                os.remove(edited_path)
+
+        timings = {stage: statistics.median(runs[stage]) for stage in engine.stages}
+        self.logger.info(
+            f"{case.name}: "
+            + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+        )
+        return BenchmarkResult(
+            case=case,
+            engine=engine,
+            cue_count=case.cue_count,
+            timings=timings,
+            runs=runs,
+        )
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": shutil.which("ffmpeg"),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def result_key(result: dict) -> str:
+    return json.dumps([result["case"], result["engine"]], sort_keys=True)
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """
+    Find the stages slower than the baseline by more than the tolerance.
+    :param tolerance: Allowed slowdown, 0.2 for 20%
+    :return: One message per regression
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if previous is None:
+            continue
+        for stage, seconds in result["timings"].items():
+            before = previous["timings"].get(stage)
+            if before and seconds > before * (1 + tolerance):
+                regressions.append(
+                    f"{BenchmarkCase.model_validate(result['case']).name} {stage}: "
+                    f"{before:.3f}s -> {seconds:.3f}s (+{seconds / before - 1:.0%})"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages.")
+    parser.add_argument("--durations", type=float, nargs="+", default=[60.0])
+    parser.add_argument("--resolutions", nargs="+", default=["1280x720"])
+    parser.add_argument("--audio", choices=["tone", "music"], nargs="+", default=["music"])
+    parser.add_argument("--cues-per-minute", type=float, nargs="+", default=[20.0])
+    parser.add_argument("--cue-seconds", type=float, default=2.5)
+    parser.add_argument("--cue-chars", type=int, default=32)
+    parser.add_argument(
+        "--subtitle-renderers", choices=["ass", "drawtext"], nargs="+", default=["ass"]
+    )
+    parser.add_argument(
+        "--profiles", choices=list(ENCODER_PROFILES), nargs="+", default=["standard"]
+    )
+    parser.add_argument("--analysis-workers", type=int, default=1)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument(
+        "--multi-pass",
+        action="store_true",
+        help="Also time applying the effects and the subtitles in separate passes",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", help="Keep the generated media in this directory")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="Results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed slowdown, 0.2 for 20%%"
+    )
+    args = parser.parse_args()
+
+    cases = [
+        BenchmarkCase(
+            track_seconds=duration,
+            width=int(resolution.split("x")[0]),
+            height=int(resolution.split("x")[1]),
+            audio=audio,
+            cues_per_minute=cues_per_minute,
+            cue_seconds=args.cue_seconds,
+            cue_chars=args.cue_chars,
+        )
+        for duration in args.durations
+        for resolution in args.resolutions
+        for audio in args.audio
+        for cues_per_minute in args.cues_per_minute
+    ]
+    engines = [
+        BenchmarkEngine(
+            subtitle_renderer=renderer,
+            analysis_workers=args.analysis_workers,
+            streaming=args.streaming,
+            encoder_profile=profile,
+            multi_pass=args.multi_pass,
+        )
+        for renderer in args.subtitle_renderers
+        for profile in args.profiles
+    ]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="lyricshort-bench-")
+    try:
+        runner = BenchmarkRunner(work_dir, repeat=args.repeat)
+        results = [
+            runner.run_case(case, engine).model_dump()
+            for case in cases
+            for engine in engines
+        ]
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "environment": environment(),
+                "results": results,
+                "effects": Metrics.AGGREGATOR.summary(),
+            },
+            f,
+            indent=2,
+        )
+    runner.logger.info(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            runner.logger.error(f"Regression: {regression}")
+        if regressions:
+            return 1
+        runner.logger.info("No regression against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+from typing import Iterable
+
+import numpy as np
+
+from logger import MyLogger
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk cache for extracted audio features.
+
+    Entries are keyed by a hash of the decoded samples and of the extraction
+    parameters, and stored as compressed ``.npz`` arrays. The modification time of
+    an entry is refreshed on every hit, and the least recently used entries are
+    evicted once the directory grows past its size budget.
+    """
+
+    DEFAULT_DIR: str = os.path.join(".cache", "features")
+    DEFAULT_MAX_BYTES: int = 512 * 1024 * 1024  # 512 MB
+
+    def __init__(
+        self,
+        cache_dir: str | None = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.cache_dir = cache_dir or os.getenv("FEATURE_CACHE_DIR", self.DEFAULT_DIR)
+        self.max_bytes = max_bytes
+        self.logger = MyLogger.get_logger("FeatureCache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(blocks: Iterable[np.ndarray], params: dict) -> str:
+        """
+        Hash decoded audio together with the extraction parameters.
+        :param blocks: The signal, as one array or as consecutive blocks
+        :param params: Parameters the features depend on
+        :return: Hex digest identifying the entry
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr(sorted(params.items())).encode("utf-8"))
+        for block in blocks:
+            digest.update(np.ascontiguousarray(block).data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key: str) -> list[dict] | None:
+        """
+        Get the features stored under a key.
+        :return: The feature records, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                features = [
+                    {
+                        "second": int(second),
+                        "mfcc": mfcc.tolist(),
+                        "chroma": chroma.tolist(),
+                        "zcr": float(zcr),
+                        "rms": float(rms),
+                        "pitch": float(pitch),
+                    }
+                    for second, mfcc, chroma, zcr, rms, pitch in zip(
+                        data["second"],
+                        data["mfcc"],
+                        data["chroma"],
+                        data["zcr"],
+                        data["rms"],
+                        data["pitch"],
+                    )
+                ]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return None
+
+        os.utime(path)  # Mark as recently used
+        return features
+
+    def put(self, key: str, features: list[dict]):
+        """
+        Store feature records under a key, then evict entries over the size budget.
+        """
+        with tempfile.NamedTemporaryFile(
+            dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as temp_file:
+            np.savez_compressed(
+                temp_file,
+                second=np.array([f["second"] for f in features], dtype=np.int64),
+                mfcc=np.array([f["mfcc"] for f in features], dtype=np.float64),
+                chroma=np.array([f["chroma"] for f in features], dtype=np.float64),
+                zcr=np.array([f["zcr"] for f in features], dtype=np.float64),
+                rms=np.array([f["rms"] for f in features], dtype=np.float64),
+                pitch=np.array([f["pitch"] for f in features], dtype=np.float64),
+            )
+        os.replace(temp_file.name, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its budget.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class JsonCache:
+    """
+    Persistent key-value cache storing one JSON document per key.
+    Entries older than the optional time-to-live are treated as misses.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float | None = None):
+        """
+        :param cache_dir: Directory holding the entries
+        :param ttl: Seconds an entry stays valid after it is stored, forever if None
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.logger = MyLogger.get_logger("JsonCache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        """
+        Hash the parts identifying an entry into a key.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")  # Keep ("ab", "c") and ("a", "bc") apart
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Get the value stored under a key.
+        :return: The decoded JSON value, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                self._remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return None
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key: str, value):
+        """
+        Store a JSON-serializable value under a key.
+        """
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as temp_file:
+            json.dump(value, temp_file)
+        os.replace(temp_file.name, self._path(key))
@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+import srt
+
+from structures import Chorus
+from logger import MyLogger
+
+
+class ChorusDetector:
+    """
+    Local chorus detection from the per-second audio features.
+
+    Chroma and MFCC vectors are compared second by second in a self-similarity
+    matrix. A section scores high when it is repeated elsewhere in the song
+    (a high-similarity diagonal of its length) and when it is loud. The best section
+    is optionally snapped to the lyric cue boundaries of an SRT file.
+    """
+
+    DURATIONS: tuple[int, ...] = (15, 20, 25, 30)  # Candidate lengths in seconds
+    REPETITION_WEIGHT: float = 0.7
+    ENERGY_WEIGHT: float = 0.3
+    SNAP_TOLERANCE: float = 3.0  # Max seconds a boundary moves to meet a lyric cue
+
+    def __init__(
+        self,
+        durations: tuple[int, ...] = DURATIONS,
+        repetition_weight: float = REPETITION_WEIGHT,
+        energy_weight: float = ENERGY_WEIGHT,
+    ):
+        self.durations = durations
+        self.repetition_weight = repetition_weight
+        self.energy_weight = energy_weight
+        self.logger = MyLogger.get_logger("ChorusDetector")
+
+    @staticmethod
+    def self_similarity(features: list[dict]) -> np.ndarray:
+        """
+        Cosine self-similarity of the standardized chroma and MFCC vectors.
+        :return: Matrix of shape (seconds, seconds) with values in [0, 1]
+        """
+        chroma = np.array([f["chroma"] for f in features], dtype=np.float64)
+        mfcc = np.array([f["mfcc"] for f in features], dtype=np.float64)
+        mfcc = (mfcc - mfcc.mean(axis=0)) / (mfcc.std(axis=0) + 1e-9)
+        vectors = np.hstack((chroma, mfcc / np.sqrt(mfcc.shape[1])))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+        return (vectors @ vectors.T + 1) / 2
+
+    @staticmethod
+    def repetition(ssm: np.ndarray, duration: int) -> np.ndarray:
+        """
+        How strongly each section of a given length repeats elsewhere in the song.
+        :param ssm: Self-similarity matrix
+        :param duration: Section length in seconds
+        :return: Score per start second, of length seconds - duration + 1
+        """
+        n = len(ssm)
+        n_starts = n - duration + 1
+        scores = np.zeros(n_starts)
+        window = np.ones(duration) / duration
+        # Only lags that do not overlap the section itself count as a repeat
+        for lag in range(duration, n - duration + 1):
+            diagonal = np.diagonal(ssm, offset=lag)
+            averaged = np.convolve(diagonal, window, mode="valid")
+            # averaged[s] compares [s, s + duration) with [s + lag, s + lag + duration)
+            np.maximum(scores[: len(averaged)], averaged, out=scores[: len(averaged)])
+            np.maximum(
+                scores[lag : lag + len(averaged)],
+                averaged,
+                out=scores[lag : lag + len(averaged)],
+            )
+        return scores
+
+    @staticmethod
+    def _normalize(values: np.ndarray) -> np.ndarray:
+        spread = values.max() - values.min()
+        if spread == 0:
+            return np.zeros_like(values)
+        return (values - values.min()) / spread
+
+    def detect(self, features: list[dict], lyrics_path: str | None = None) -> Chorus:
+        """
+        Find the most repeated high-energy section of the song.
+        :param features: Per-second feature records from SoundAnalyzer
+        :param lyrics_path: Optional SRT file to align the boundaries with
+        :return: The detected chorus
+        """
+        n = len(features)
+        durations = [d for d in self.durations if d <= n // 2]
+        if not durations:
+            raise ValueError(f"Song of {n} seconds is too short to detect a chorus.")
+
+        ssm = self.self_similarity(features)
+        rms = np.array([f["rms"] for f in features], dtype=np.float64)
+        energy_cumsum = np.concatenate(([0.0], np.cumsum(rms)))
+
+        best_score, best_start, best_duration = -np.inf, 0, durations[0]
+        for duration in durations:
+            repetition = self._normalize(self.repetition(ssm, duration))
+            energy = self._normalize(
+                (energy_cumsum[duration:] - energy_cumsum[:-duration]) / duration
+            )
+            scores = (
+                self.repetition_weight * repetition + self.energy_weight * energy
+            )
+            start = int(np.argmax(scores))
+            if scores[start] > best_score:
+                best_score, best_start, best_duration = scores[start], start, duration
+
+        start_time = float(best_start)
+        end_time = float(best_start + best_duration)
+        self.logger.info(
+            f"Local chorus candidate from {start_time:.2f} to {end_time:.2f} "
+            f"seconds with score {best_score:.4f}"
+        )
+
+        if lyrics_path is not None and os.path.exists(lyrics_path):
+            start_time, end_time = self.align_to_lyrics(
+                start_time, end_time, lyrics_path
+            )
+        return Chorus(start_time=start_time, end_time=end_time)
+
+    def align_to_lyrics(
+        self, start_time: float, end_time: float, lyrics_path: str
+    ) -> tuple[float, float]:
+        """
+        Move the boundaries to the closest lyric cue start and end, if close enough.
+        :param lyrics_path: Path to the SRT file
+        :return: Aligned (start_time, end_time)
+        """
+        with open(lyrics_path, "r", encoding="utf-8") as f:
+            cues = list(srt.parse(f.read()))
+        if not cues:
+            return start_time, end_time
+
+        starts = np.array([cue.start.total_seconds() for cue in cues])
+        ends = np.array([cue.end.total_seconds() for cue in cues])
+
+        closest_start = starts[np.argmin(np.abs(starts - start_time))]
+        if abs(closest_start - start_time) <= self.SNAP_TOLERANCE:
+            start_time = float(closest_start)
+        closest_end = ends[np.argmin(np.abs(ends - end_time))]
+        if (
+            abs(closest_end - end_time) <= self.SNAP_TOLERANCE
+            and closest_end > start_time
+        ):
+            end_time = float(closest_end)
+        return start_time, end_time
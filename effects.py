@@ -1,25 +1,36 @@
 import os
 import tempfile
-from typing import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Sequence
 import math
 
 import ffmpeg
 import srt
 
 from logger import MyLogger
+from tracing import Tracer
+from metrics import Metrics
 from utils import StreamUtils, FontUtils
 from structures import (
     Effect,
     TrimEffect,
     TextOverlayEffect,
+    AssSubtitleEffect,
     TextOverlayProperties,
     FillOverlayEffect,
+    EncoderProfile,
+    OutputTarget,
     TextPosition,
     UserPrompts,
 )
 
 
 class EditorEffects:
+    MIN_CHUNK_SECONDS: float = 10  # Shorter chunks spend more on encoder start-up
+    # Short side of the frame the subtitle sizes are designed for, subtitles laid out
+    # for another frame size are scaled from it
+    SUBTITLE_REFERENCE_SIZE: int = 720
+
     def __init__(
         self,
         file_path: str,
@@ -27,13 +38,36 @@ class EditorEffects:
         start_time: float = 25,
         duration: float = 20,
         metadata=None,
+        subtitle_renderer: Literal["ass", "drawtext"] = "ass",
+        source_offset: float = 0,
+        chunk_workers: int = 1,
+        profile: str = "standard",
+        targets: Sequence[OutputTarget] = (),
     ):
+        """
+        :param start_time: Start of the segment in the original video, in seconds
+        :param subtitle_renderer: "ass" burns all subtitles from one ASS track,
+            "drawtext" chains one drawtext filter per line
+        :param source_offset: Time of the original video at which the source file
+            starts, when only a segment of the video was downloaded
+        :param chunk_workers: Split long renders into this many chunks encoded in
+            parallel, each by its own ffmpeg process
+        :param profile: Encoder profile, see ENCODER_PROFILES, "draft" renders a
+            quick downscaled preview
+        :param targets: Outputs rendered from a single decode of the source, each
+            with its own geometry and profile, instead of the output file
+        """
         self.file_path = file_path
         self.subtitle_path = subtitle_path
         self.logger = MyLogger.get_logger("EditorEffects")
         self.metadata = metadata
         self.start_time = start_time
         self.duration = duration
+        self.subtitle_renderer = subtitle_renderer
+        self.source_offset = source_offset
+        self.chunk_workers = chunk_workers
+        self.profile = EncoderProfile.get(profile)
+        self.targets = list(targets)
 
     def apply_effects_individual(self, effects: Sequence[Effect]):
         """
@@ -77,54 +111,324 @@ class EditorEffects:
             f"Applying effects: {[effect.__class__.__name__ for effect in effects]}"
         )
         effects[0].apply(self.file_path)
-        input_stream = ffmpeg.input(self.file_path)
-        video_node: ffmpeg.nodes.FilterableStream = input_stream.video
-        audio_node = input_stream.audio
+        with Metrics.measure("apply_effects", self.file_path, [self.file_path]):
+            self._render_graph(self.file_path, effects)
+        self.logger.info("All effects applied successfully.")
+
+    def render(self, source_path: str, effects: Sequence[Effect]):
+        """
+        Render the source video with all effects into the output file in one pass.
+        The source is read once, a TrimEffect becomes an accurate input seek, and the
+        other effects are chained into a single filter graph that is encoded once.
+        :param source_path: Path to the untouched source video
+        :param effects: List of Effect instances, at most one TrimEffect
+        """
+        input_args, graph_effects = self._split_trim(effects)
+        self.logger.info(
+            f"Rendering {source_path} with effects: "
+            f"{[effect.__class__.__name__ for effect in effects]}"
+        )
+        with Metrics.measure("render", source_path, [self.file_path]):
+            self._render_graph(source_path, graph_effects, input_args)
+        self.logger.info(f"Rendered {self.file_path}.")
+
+    def _split_trim(self, effects: Sequence[Effect]) -> tuple[dict, list[Effect]]:
+        """
+        Turn the TrimEffect of the effects into an input seek.
+        :return: (ffmpeg input options, the other effects)
+        """
+        trims = [effect for effect in effects if isinstance(effect, TrimEffect)]
+        if len(trims) > 1:
+            self.logger.error("Use only one TrimEffect at a time. Found multiple.")
+            raise ValueError("Multiple TrimEffects found, only one is allowed.")
 
+        input_args = {}
+        if trims:
+            # Input seek, frame accurate since the video is re-encoded
+            input_args = {"ss": trims[0].start_time, "to": trims[0].end_time}
+        return input_args, [
+            effect for effect in effects if not isinstance(effect, TrimEffect)
+        ]
+
+    @staticmethod
+    def _effects_graph(
+        source_path: str, effects: Sequence[Effect], input_args: dict
+    ) -> tuple[ffmpeg.nodes.FilterableStream, ffmpeg.nodes.FilterableStream]:
+        """
+        Decode the source and chain the effects into one filter graph.
+        :param input_args: ffmpeg input options, "ss" and "to" select the segment
+        :return: (input stream, filtered video node)
+        """
+        input_stream = ffmpeg.input(source_path, **input_args)
+        video_node: ffmpeg.nodes.FilterableStream = input_stream.video
         for effect in effects:
-            video_node: ffmpeg.nodes.FilterableStream = effect.video_node(
-                video_node, self.file_path
+            video_node = effect.video_node(video_node, source_path)
+        return input_stream, video_node
+
+    @staticmethod
+    def _acodec(audio_source: str) -> str:
+        """
+        Copy AAC audio, encode anything else to AAC.
+        """
+        return "copy" if StreamUtils.get_audio_codec(audio_source) == "aac" else "aac"
+
+    def _log_ffmpeg_error(self, e: ffmpeg.Error):
+        self.logger.error(f"Error applying effects : {e}")
+        self.logger.error(e.stdout.decode("utf-8") if e.stdout else "No ffmpeg stdout")
+        self.logger.error(e.stderr.decode("utf-8") if e.stderr else "No ffmpeg stderr")
+
+    def _render_graph(
+        self,
+        source_path: str,
+        effects: Sequence[Effect],
+        input_args: dict | None = None,
+        **output_args,
+    ):
+        """
+        Chain the effects into one filter graph and encode it into the output file,
+        in parallel chunks if chunk_workers allows it.
+        :param input_args: ffmpeg input options, "ss" and "to" select the segment
+        :param output_args: Extra ffmpeg output options
+        """
+        input_args = input_args or {}
+        if self.chunk_workers > 1:
+            start = input_args.get("ss", 0.0)
+            end = input_args.get("to") or StreamUtils.get_duration(source_path)
+            if end is not None:
+                boundaries = self._chunk_boundaries(source_path, start, end)
+                if len(boundaries) > 2:
+                    self._render_chunked(source_path, effects, boundaries, **output_args)
+                    return
+
+        input_stream, video_node = self._effects_graph(source_path, effects, input_args)
+        video_node = self.profile.scale_node(video_node)
+        self._encode(video_node, input_stream.audio, source_path, **output_args)
+
+    def render_targets(self, source_path: str, effects: Sequence[Effect]):
+        """
+        Render the source into every output target with a single ffmpeg command.
+        The source is decoded once and the effects are applied once, then the video
+        is split into one branch per target, scaled and cropped or padded to its
+        frame, given subtitles laid out for that frame and encoded with its profile.
+        Targets are not rendered in chunks, the branches already share the cores.
+        :param source_path: Path to the untouched source video
+        :param effects: List of Effect instances, at most one TrimEffect
+        """
+        input_args, graph_effects = self._split_trim(effects)
+        self.logger.info(
+            f"Rendering {source_path} to {[target.path for target in self.targets]} "
+            f"with effects: {[effect.__class__.__name__ for effect in effects]}"
+        )
+        input_stream, video_node = self._effects_graph(
+            source_path, graph_effects, input_args
+        )
+        acodec = self._acodec(source_path)
+        branches = video_node.split()  # type: ignore[reportAttributeAccessIssue]
+
+        outputs, temp_paths, ass_paths = [], [], []
+        try:
+            for i, target in enumerate(self.targets):
+                branch = target.video_node(branches[i])
+                subtitle_overlay = self.subtitle_overlay(
+                    frame_size=target.size,
+                    ass_path=os.path.splitext(target.path)[0] + ".ass",
+                )
+                if subtitle_overlay is not None:
+                    if isinstance(subtitle_overlay, AssSubtitleEffect):
+                        ass_paths.append(subtitle_overlay.ass_path)
+                    branch = subtitle_overlay.video_node(branch, source_path)
+
+                with tempfile.NamedTemporaryFile(
+                    suffix=".mp4", delete=False
+                ) as temp_file:
+                    temp_paths.append(temp_file.name)
+                outputs.append(
+                    ffmpeg.output(
+                        branch,
+                        input_stream.audio,
+                        temp_file.name,
+                        **{**target.encoder.output_args(), "acodec": acodec},
+                    )
+                )
+
+            stream = (
+                ffmpeg.merge_outputs(*outputs)
+                .overwrite_output()
+                .global_args(*Effect.GLOBAL_ARGS)
+            )
+            with Metrics.measure(
+                "render_targets",
+                source_path,
+                [target.path for target in self.targets],
+            ):
+                Tracer.run_ffmpeg(stream, "encode targets")
+                for target, temp_path in zip(self.targets, temp_paths):
+                    os.replace(temp_path, target.path)
+                    StreamUtils.invalidate(target.path)
+
+        except ffmpeg.Error as e:
+            self._log_ffmpeg_error(e)
+            raise
+        finally:
+            for path in temp_paths + ass_paths:
+                if path and os.path.exists(path):
+                    os.remove(path)
+        self.logger.info(f"Rendered {[target.path for target in self.targets]}.")
+
+    def _chunk_boundaries(self, source_path: str, start: float, end: float) -> list[float]:
+        """
+        Split a segment into chunks of about equal length, each starting on a
+        keyframe of the source when one is close, so the input seek of every chunk
+        decodes almost nothing it throws away.
+        :return: Chunk boundaries from start to end, empty if not worth splitting
+        """
+        count = min(self.chunk_workers, int((end - start) // self.MIN_CHUNK_SECONDS))
+        if count < 2:
+            return []
+        length = (end - start) / count
+
+        try:
+            keyframes = StreamUtils.get_keyframes(source_path, start, end)
+        except (ffmpeg.Error, OSError) as e:
+            self.logger.warning(f"Could not read keyframes, splitting evenly: {e}")
+            keyframes = []
+
+        # Boundaries between two frames would duplicate a frame in both chunks
+        fps = StreamUtils.get_frame_rate(source_path)
+        boundaries = [start]
+        for i in range(1, count):
+            ideal = start + i * length
+            if fps:
+                ideal = round(ideal * fps) / fps
+            close = [
+                keyframe
+                for keyframe in keyframes
+                if abs(keyframe - ideal) <= length / 4 and keyframe > boundaries[-1]
+            ]
+            boundaries.append(
+                min(close, key=lambda keyframe: abs(keyframe - ideal)) if close else ideal
+            )
+        boundaries.append(end)
+        return boundaries
+
+    def _render_chunked(
+        self,
+        source_path: str,
+        effects: Sequence[Effect],
+        boundaries: list[float],
+        **output_args,
+    ):
+        """
+        Encode every chunk with the same filter graph in parallel, then join them
+        with the concat demuxer without re-encoding and mux the audio of the segment.
+        """
+        chunk_count = len(boundaries) - 1
+        # Share the cores between the encoders instead of oversubscribing them
+        threads = self.profile.threads or max(1, (os.cpu_count() or 1) // chunk_count)
+        self.logger.info(
+            f"Encoding {boundaries[-1] - boundaries[0]:.2f}s in {chunk_count} chunks "
+            f"at {[round(boundary, 3) for boundary in boundaries]}"
+        )
+        # The chunks are encoded on worker threads, outside the span of the render
+        parent = Tracer.current()
+
+        def encode_chunk(i: int, chunk_dir: str) -> str:
+            offset = boundaries[i] - boundaries[0]
+            chunk_effects = [effect.shifted(offset) for effect in effects]
+            _, video_node = self._effects_graph(
+                source_path,
+                chunk_effects,
+                {"ss": boundaries[i], "to": boundaries[i + 1]},
             )
+            video_node = self.profile.scale_node(video_node)
+            chunk_path = os.path.join(chunk_dir, f"chunk{i:04d}.mp4")
+            try:
+                Tracer.run_ffmpeg(
+                    ffmpeg.output(
+                        video_node,
+                        chunk_path,
+                        **{
+                            **self.profile.output_args(),
+                            "threads": threads,
+                            **output_args,
+                        },
+                    )
+                    .overwrite_output()
+                    .global_args(*Effect.GLOBAL_ARGS),
+                    f"encode chunk {i}",
+                    parent=parent,
+                )
+            finally:
+                for effect in chunk_effects:
+                    if isinstance(effect, AssSubtitleEffect) and effect.ass_path:
+                        if os.path.exists(effect.ass_path):
+                            os.remove(effect.ass_path)
+            return chunk_path
+
+        with tempfile.TemporaryDirectory(prefix="chunks-") as chunk_dir:
+            with ThreadPoolExecutor(max_workers=chunk_count) as pool:
+                chunk_paths = list(
+                    pool.map(encode_chunk, range(chunk_count), [chunk_dir] * chunk_count)
+                )
 
+            list_path = os.path.join(chunk_dir, "chunks.txt")
+            with open(list_path, "w", encoding="utf-8") as f:
+                for chunk_path in chunk_paths:
+                    escaped = chunk_path.replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+
+            video = ffmpeg.input(list_path, f="concat", safe=0).video
+            audio = ffmpeg.input(source_path, ss=boundaries[0], to=boundaries[-1]).audio
+            self._encode(video, audio, source_path, copy_video=True)
+
+    def _encode(
+        self,
+        video_node: ffmpeg.nodes.FilterableStream,
+        audio_node: ffmpeg.nodes.FilterableStream,
+        audio_source: str,
+        copy_video: bool = False,
+        **output_args,
+    ):
+        """
+        Encode the video and audio nodes into the output file with the encoder profile.
+        :param audio_source: File the audio node reads from, to decide whether to copy it
+        :param copy_video: Copy the already encoded video instead of encoding it
+        :param output_args: Extra ffmpeg output options
+        """
         try:
-            audio_codec = StreamUtils.get_audio_codec(self.file_path)
-            acodec = "copy" if audio_codec == "aac" else "aac"
+            acodec = self._acodec(audio_source)
+            video_args = (
+                {"vcodec": "copy"} if copy_video else self.profile.output_args()
+            )
 
             with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-                (
+                stream = (
                     ffmpeg.output(
                         video_node,
                         audio_node,
                         temp_file.name,
-                        vcodec="libx264",
-                        acodec=acodec,
+                        **{**video_args, "acodec": acodec, **output_args},
                     )
                     .overwrite_output()
                     .global_args(*Effect.GLOBAL_ARGS)
-                    .run()
                 )
+                Tracer.run_ffmpeg(stream, "encode")
                 os.replace(temp_file.name, self.file_path)
+                StreamUtils.invalidate(self.file_path)
 
         except ffmpeg.Error as e:
-            self.logger.error(f"Error applying effects : {e}")
-            self.logger.error(
-                e.stdout.decode("utf-8") if e.stdout else "No ffmpeg stdout"
-            )
-            self.logger.error(
-                e.stderr.decode("utf-8") if e.stderr else "No ffmpeg stderr"
-            )
+            self._log_ffmpeg_error(e)
             raise
 
-        self.logger.info("All effects applied successfully.")
-
-    def effects_vid(
-        self,
-        user_prompts: UserPrompts,
-    ):
-        trim = TrimEffect(
-            start_time=self.start_time, end_time=self.start_time + self.duration
+    def vid_effects(self, user_prompts: UserPrompts) -> list[Effect]:
+        """
+        Effects applied to every video, trim first.
+        """
+        start_time = self.start_time - self.source_offset
+        trim = TrimEffect(start_time=start_time, end_time=start_time + self.duration)
+        fill_overlay = FillOverlayEffect(
+            color="black", opacity=0.6, profile=self.profile.name
         )
-        fill_overlay = FillOverlayEffect(color="black", opacity=0.6)
         # text_overlay = TextOverlayEffect(
         #     texts=[
         #         TextOverlayProperties(
@@ -140,80 +444,178 @@ class EditorEffects:
         #         )
         #     ]
         # )
+        return [trim, fill_overlay]
 
+    def effects_vid(
+        self,
+        user_prompts: UserPrompts,
+    ):
         try:
-            self.apply_effects([trim, fill_overlay])
+            self.apply_effects(self.vid_effects(user_prompts))
             self.logger.info(f"Applied all effects to {self.file_path}")
         except ffmpeg.Error as e:
             self.logger.error(f"Error applying effects: {e}")
             raise
 
+    def render_vid(self, source_path: str, user_prompts: UserPrompts):
+        """
+        Render the trimmed video with its effects and subtitles in a single pass.
+        :param source_path: Path to the downloaded video, left untouched
+        """
+        effects = self.vid_effects(user_prompts)
+        if self.targets:
+            self.render_targets(source_path, effects)
+            return
+        with tempfile.NamedTemporaryFile(suffix=".ass", delete=False) as ass_file:
+            ass_path = ass_file.name
+        try:
+            subtitle_overlay = self.subtitle_overlay(ass_path=ass_path)
+            if subtitle_overlay is not None:
+                effects.append(subtitle_overlay)
+            self.render(source_path, effects)
+        finally:
+            os.remove(ass_path)
+
     def add_subtitles(self):
         """
         Add subtitles to the video.
         """
-        FONT_SIZE = 35
-        INIT_OFFSET = 20
-        LINE_GAP = 5
+        subtitle_overlay = self.subtitle_overlay()
+        if subtitle_overlay is None:
+            return
+        subtitle_overlay.apply(self.file_path)
+
+    @staticmethod
+    def _wrap(
+        text: str, font_size: int, max_width: float, font_path: str | None = None
+    ) -> list[str]:
+        """
+        Break the text at spaces into lines no wider than max_width.
+        A word wider than max_width gets a line of its own.
+        """
+        words = text.split()
+        lines = []
+        while words:
+            widths = FontUtils.get_fonts_dimensions(
+                font_size,
+                [" ".join(words[: i + 1]) for i in range(len(words))],
+                font_path,
+            )
+            count = next(
+                (i for i, (width, _) in enumerate(widths) if width > max_width),
+                len(words),
+            )
+            count = max(count, 1)
+            lines.append(" ".join(words[:count]))
+            words = words[count:]
+        return lines or [text]
+
+    def subtitle_overlay(
+        self,
+        frame_size: tuple[int, int] | None = None,
+        ass_path: str | None = None,
+    ) -> TextOverlayEffect | AssSubtitleEffect | None:
+        """
+        Build the effect showing the subtitles within the trim range.
+        :param frame_size: (width, height) the subtitles are laid out for, their size
+            follows the short side of the frame and long lines are wrapped to its
+            width. The size of the video they are burned into if None
+        :param ass_path: Where the ASS renderer writes its document,
+            a temporary file while the effect is applied if None
+        :return: The effect, or None when the subtitle file is missing
+        """
+        font_scale = (
+            min(frame_size) / self.SUBTITLE_REFERENCE_SIZE if frame_size else 1.0
+        )
+        FONT_SIZE = max(1, round(35 * font_scale))
+        INIT_OFFSET = round(20 * font_scale)
+        LINE_GAP = round(5 * font_scale)
 
         if not os.path.exists(self.subtitle_path):
             self.logger.error(f"Subtitle file {self.subtitle_path} does not exist.")
-            return
+            return None
 
+        subtitles: list[srt.Subtitle] = []
         with open(self.subtitle_path, "r", encoding="utf-8") as file:
-            subtitles = srt.parse(file.read())
+            for subtitle in srt.parse(file.read()):
+                text: str = subtitle.content.replace("\n", " ").strip()
+                if subtitle.end.total_seconds() < self.start_time:
+                    self.logger.info(
+                        f"Subtitle {subtitle.index} '{text}' is outside the trim range, skipping."
+                    )
+                    continue
+                if subtitle.start.total_seconds() - self.start_time > self.duration:
+                    self.logger.info(
+                        f"Subtitle {subtitle.index} '{text}' is outside the duration range, ending."
+                    )
+                    break
+                subtitles.append(subtitle)
 
+        # One font for every subtitle of the clip when a font has all their glyphs,
+        # otherwise a font per subtitle
+        font_path = FontUtils.find_font_for_text(
+            "".join(subtitle.content for subtitle in subtitles)
+        )
         subtitle_props: list[TextOverlayProperties] = []
         overlay_spots: dict[int, float] = {}
-        _, font_height = FontUtils.get_font_dimensions(FONT_SIZE, "PLACEHOLDER")
 
         for subtitle in subtitles:
-            text: str = subtitle.content.replace("\n", " ").strip()
+            text = subtitle.content.replace("\n", " ").strip()
             start_time: float = subtitle.start.total_seconds() - self.start_time
             end_time: float = subtitle.end.total_seconds() - self.start_time
 
-            if end_time < 0:
-                self.logger.info(
-                    f"Subtitle {subtitle.index} '{text}' is outside the trim range, skipping."
+            text_font = font_path or FontUtils.find_font_for_text(text)
+            if text_font is None:
+                self.logger.warning(
+                    f"No font has every glyph of subtitle {subtitle.index} '{text}'."
                 )
-                continue
-            if start_time > self.duration:
-                self.logger.info(
-                    f"Subtitle {subtitle.index} '{text}' is outside the duration range, ending."
+            lines = [text]
+            if frame_size is not None:
+                lines = self._wrap(
+                    text, FONT_SIZE, frame_size[0] - 2 * INIT_OFFSET, text_font
                 )
-                break
 
+            def is_free(offset: int) -> bool:
+                return offset not in overlay_spots or start_time >= overlay_spots[offset]
+
+            # First spot with room for every line of the subtitle
             current_offset = INIT_OFFSET
-            while True:
-                if current_offset in overlay_spots:
-                    end_last = overlay_spots[current_offset]
-                    if start_time >= end_last:
-                        break
-                else:
-                    break
+            while not all(
+                is_free(current_offset + i * FONT_SIZE) for i in range(len(lines))
+            ):
                 current_offset += FONT_SIZE
 
-            overlay_spots[current_offset] = end_time
             self.logger.info(
                 f"Adding subtitle: {subtitle.index}, '{text}' from {start_time} to {end_time}"
             )
+            for i, line in enumerate(lines):
+                line_offset = current_offset + i * FONT_SIZE
+                overlay_spots[line_offset] = end_time
+                subtitle_prop = TextOverlayProperties(
+                    text=line,
+                    position=TextPosition(
+                        vertical="center",
+                        horizontal="center",
+                    ),
+                    font_size=FONT_SIZE,
+                    color="white",
+                    start_time=start_time,
+                    duration=int(end_time - start_time),
+                    font_path=text_font,
+                    offset=(
+                        0,
+                        line_offset + (line_offset - INIT_OFFSET) // FONT_SIZE * LINE_GAP,
+                    ),
+                )
+                subtitle_props.append(subtitle_prop)
 
-            subtitle_prop = TextOverlayProperties(
-                text=text,
-                position=TextPosition(
-                    vertical="center",
-                    horizontal="center",
-                ),
-                font_size=FONT_SIZE,
-                color="white",
-                start_time=start_time,
-                duration=int(end_time - start_time),
-                offset=(
-                    0,
-                    current_offset
-                    + (current_offset - INIT_OFFSET) // FONT_SIZE * LINE_GAP,
-                ),
+        if self.subtitle_renderer == "drawtext":
+            return TextOverlayEffect(
+                texts=subtitle_props, frame_size=frame_size, profile=self.profile.name
             )
-            subtitle_props.append(subtitle_prop)
-
-        TextOverlayEffect(texts=subtitle_props).apply(self.file_path)
+        return AssSubtitleEffect(
+            texts=subtitle_props,
+            ass_path=ass_path,
+            frame_size=frame_size,
+            profile=self.profile.name,
+        )
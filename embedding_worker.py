@@ -0,0 +1,280 @@
+"""
+Long-lived embedding worker keeping the SentenceTransformer model in memory.
+
+Pipeline runs send encode requests over a local Unix socket instead of loading the
+model themselves. Requests arriving within a short window are encoded together in
+one batch. Run it with `python embedding_worker.py`, pipelines find it through the
+EMBEDDING_SOCKET path and load the model in-process when no worker is listening.
+
+Protocol, one request per line on a persistent connection:
+    -> {"texts": [...], "normalize": true}\\n
+    <- {"shape": [n, dim]}\\n followed by n * dim float32 values
+    <- {"error": "..."}\\n on failure
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+from logger import MyLogger
+
+DEFAULT_SOCKET: str = os.getenv(
+    "EMBEDDING_SOCKET", os.path.join("/tmp", "lyricshort-embedding.sock")
+)
+DEFAULT_MODEL: str = "all-MiniLM-L6-v2"
+
+
+class _EncodeRequest:
+    def __init__(self, texts: list[str], normalize: bool):
+        self.texts = texts
+        self.normalize = normalize
+        self.result: np.ndarray | None = None
+        self.error: str | None = None
+        self.done = threading.Event()
+
+
+class EmbeddingWorker:
+    """
+    Serves batched encode requests from many concurrent pipeline runs.
+    """
+
+    MAX_BATCH: int = 256  # Max texts encoded in one model call
+    BATCH_WINDOW: float = 0.005  # Seconds to wait for more requests to join a batch
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET,
+        model_name: str = DEFAULT_MODEL,
+        max_batch: int = MAX_BATCH,
+        batch_window: float = BATCH_WINDOW,
+        model=None,
+    ):
+        """
+        :param model: Already loaded model, loaded from model_name if not given
+        """
+        self.socket_path = socket_path
+        self.model_name = model_name
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.model = model
+        self.logger = MyLogger.get_logger("EmbeddingWorker")
+        self._requests: queue.Queue[_EncodeRequest] = queue.Queue()
+        self._server: socketserver.ThreadingUnixStreamServer | None = None
+
+    def encode(self, texts: list[str], normalize: bool) -> np.ndarray:
+        """
+        Queue texts for the next batch and wait for their embeddings.
+        """
+        request = _EncodeRequest(texts, normalize)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        assert request.result is not None
+        return request.result
+
+    def _collect_batch(self) -> list[_EncodeRequest]:
+        batch = [self._requests.get()]
+        count = len(batch[0].texts)
+        deadline = time.monotonic() + self.batch_window
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            count += len(request.texts)
+        return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._collect_batch()
+            for normalize in (False, True):
+                group = [request for request in batch if request.normalize == normalize]
+                if not group:
+                    continue
+                texts = [text for request in group for text in request.texts]
+                try:
+                    embeddings = np.asarray(
+                        self.model.encode(texts, normalize_embeddings=normalize),
+                        dtype=np.float32,
+                    )
+                except Exception as e:
+                    self.logger.error(f"Failed to encode a batch of {len(texts)}: {e}")
+                    for request in group:
+                        request.error = str(e)
+                        request.done.set()
+                    continue
+
+                offset = 0
+                for request in group:
+                    request.result = embeddings[offset : offset + len(request.texts)]
+                    offset += len(request.texts)
+                    request.done.set()
+            self.logger.info(
+                f"Encoded {sum(len(r.texts) for r in batch)} texts "
+                f"from {len(batch)} requests"
+            )
+
+    def serve_forever(self):
+        """
+        Load the model and serve requests until shutdown is called.
+        :raises RuntimeError: If another worker is listening on the socket
+        """
+        if EmbeddingClient.available(self.socket_path):
+            raise RuntimeError(
+                f"An embedding worker is already listening on {self.socket_path}."
+            )
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self.logger.info(f"Loading SentenceTransformer model {self.model_name}...")
+            self.model = SentenceTransformer(self.model_name)
+            self.logger.info("Model loaded successfully.")
+
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # Stale socket, no worker answered on it
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                        embeddings = worker.encode(
+                            list(request["texts"]), bool(request.get("normalize"))
+                        )
+                    except Exception as e:
+                        self.wfile.write(json.dumps({"error": str(e)}).encode() + b"\n")
+                        continue
+                    self.wfile.write(
+                        json.dumps({"shape": list(embeddings.shape)}).encode() + b"\n"
+                    )
+                    self.wfile.write(embeddings.tobytes())
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        self.logger.info(f"Embedding worker listening on {self.socket_path}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class EmbeddingClient:
+    """
+    Encodes texts through a running EmbeddingWorker.
+    Exposes the encode method the ranking code uses on a SentenceTransformer.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket: socket.socket | None = None
+        self._file = None
+
+    @staticmethod
+    def available(socket_path: str = DEFAULT_SOCKET) -> bool:
+        """
+        Check whether a worker is listening on the socket.
+        """
+        if not os.path.exists(socket_path):
+            return False
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.settimeout(1.0)
+                probe.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+    def _connect(self):
+        self.close()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        self._socket.connect(self.socket_path)
+        self._file = self._socket.makefile("rwb")
+
+    def _request(self, texts: list[str], normalize: bool) -> np.ndarray:
+        if self._file is None:
+            self._connect()
+        assert self._file is not None
+        self._file.write(
+            json.dumps({"texts": texts, "normalize": normalize}).encode() + b"\n"
+        )
+        self._file.flush()
+        header_line = self._file.readline()
+        if not header_line:
+            raise ConnectionError("Embedding worker closed the connection.")
+        header = json.loads(header_line)
+        if "error" in header:
+            raise RuntimeError(f"Embedding worker error: {header['error']}")
+        shape = tuple(header["shape"])
+        n_bytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        data = self._file.read(n_bytes)
+        if len(data) != n_bytes:
+            raise ConnectionError("Embedding worker sent a truncated response.")
+        return np.frombuffer(data, dtype=np.float32).reshape(shape)
+
+    def encode(self, texts: list[str], normalize_embeddings: bool = False) -> np.ndarray:
+        """
+        Encode texts, reconnecting once if the connection went stale.
+        :return: Array of shape (len(texts), dim)
+        """
+        with self._lock:
+            try:
+                return self._request(list(texts), normalize_embeddings)
+            except (ConnectionError, OSError):
+                self._connect()
+                return self._request(list(texts), normalize_embeddings)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve embeddings over a Unix socket.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-batch", type=int, default=EmbeddingWorker.MAX_BATCH)
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=EmbeddingWorker.BATCH_WINDOW,
+        help="Seconds to wait for more requests to join a batch",
+    )
+    args = parser.parse_args()
+    try:
+        EmbeddingWorker(
+            args.socket, args.model, args.max_batch, args.batch_window
+        ).serve_forever()
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == "__main__":
+    main()
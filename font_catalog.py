@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import bisect
+import tempfile
+
+from pydantic import BaseModel
+
+from logger import MyLogger
+
+
+class FontEntry(BaseModel):
+    """
+    Represents an indexed font file.
+    """
+
+    path: str
+    family: str
+    style: str  # Subfamily name, e.g. "Bold Italic"
+    weight: int  # OS/2 weight class, 400 is regular and 700 bold
+    italic: bool
+    coverage: list[tuple[int, int]]  # Sorted inclusive ranges of Unicode code points
+
+    def covers(self, text: str) -> bool:
+        """
+        Check whether the font has a glyph for every non-space character of the text.
+        """
+        for char in set(text):
+            if char.isspace():
+                continue
+            code_point = ord(char)
+            # Last range starting at or before the code point
+            i = bisect.bisect_right(self.coverage, (code_point, sys.maxsize)) - 1
+            if i < 0 or code_point > self.coverage[i][1]:
+                return False
+        return True
+
+
+class FontCatalog:
+    """
+    Index of the font files of a directory: family, weight, style and Unicode coverage.
+
+    The index is built once, persisted as JSON and only rebuilt when the
+    modification time of the fonts directory changes.
+    """
+
+    FONT_EXTENSIONS: set[str] = {".ttf", ".otf", ".woff", ".woff2", ".ttc"}
+    INDEX_VERSION: int = 1  # Bump when FontEntry changes
+
+    def __init__(self, fonts_dir: str = "fonts/static", index_path: str | None = None):
+        self.fonts_dir = fonts_dir
+        self.index_path = index_path or os.path.join(".cache", "font_catalog.json")
+        self.logger = MyLogger.get_logger("FontCatalog")
+        self._entries: list[FontEntry] | None = None
+        self._dir_mtime: int | None = None
+
+    @property
+    def entries(self) -> list[FontEntry]:
+        """
+        The indexed fonts, sorted by path. Refreshed if the directory changed.
+        """
+        if not os.path.exists(self.fonts_dir):
+            raise FileNotFoundError(
+                f"Fonts directory '{self.fonts_dir}' does not exist."
+            )
+        dir_mtime = os.stat(self.fonts_dir).st_mtime_ns
+        if self._entries is None or self._dir_mtime != dir_mtime:
+            self._entries = self._load(dir_mtime)
+            self._dir_mtime = dir_mtime
+        return self._entries
+
+    def _load(self, dir_mtime: int) -> list[FontEntry]:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if (
+                index["version"] == self.INDEX_VERSION
+                and index["fonts_dir"] == self.fonts_dir
+                and index["dir_mtime"] == dir_mtime
+            ):
+                return [FontEntry.model_validate(entry) for entry in index["fonts"]]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Ignoring unreadable font index {self.index_path}: {e}")
+
+        entries = self._build()
+        self._save(entries, dir_mtime)
+        return entries
+
+    def _build(self) -> list[FontEntry]:
+        self.logger.info(f"Indexing fonts in {self.fonts_dir}...")
+        entries = []
+        for name in sorted(os.listdir(self.fonts_dir)):
+            path = os.path.join(self.fonts_dir, name)
+            if os.path.splitext(name)[1].lower() not in self.FONT_EXTENSIONS:
+                continue
+            try:
+                entries.append(self._index_font(path))
+            except Exception as e:
+                self.logger.warning(f"Skipping unreadable font {path}: {e}")
+        self.logger.info(f"Indexed {len(entries)} fonts.")
+        return entries
+
+    @staticmethod
+    def _index_font(path: str) -> FontEntry:
+        # Only needed when the index is rebuilt
+        from fontTools.ttLib import TTFont, TTCollection
+
+        if path.lower().endswith(".ttc"):
+            font = TTCollection(path, lazy=True).fonts[0]
+        else:
+            font = TTFont(path, lazy=True)
+        try:
+            names = font["name"]
+            family = names.getBestFamilyName() or os.path.basename(path)
+            style = names.getBestSubFamilyName() or "Regular"
+            os2 = font["OS/2"] if "OS/2" in font else None
+            weight = os2.usWeightClass if os2 is not None else 400
+            italic = bool(os2.fsSelection & 1) if os2 is not None else False
+
+            coverage: list[tuple[int, int]] = []
+            for code_point in sorted(font.getBestCmap() or {}):
+                if coverage and code_point == coverage[-1][1] + 1:
+                    coverage[-1] = (coverage[-1][0], code_point)
+                else:
+                    coverage.append((code_point, code_point))
+        finally:
+            font.close()
+
+        return FontEntry(
+            path=path,
+            family=family,
+            style=style,
+            weight=weight,
+            italic=italic,
+            coverage=coverage,
+        )
+
+    def _save(self, entries: list[FontEntry], dir_mtime: int):
+        index_dir = os.path.dirname(self.index_path) or "."
+        os.makedirs(index_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=index_dir, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as temp_file:
+            json.dump(
+                {
+                    "version": self.INDEX_VERSION,
+                    "fonts_dir": self.fonts_dir,
+                    "dir_mtime": dir_mtime,
+                    "fonts": [entry.model_dump() for entry in entries],
+                },
+                temp_file,
+            )
+        os.replace(temp_file.name, self.index_path)
+
+    def find(
+        self,
+        family: str | None = None,
+        weight: int | None = None,
+        italic: bool | None = None,
+    ) -> list[FontEntry]:
+        """
+        Get the fonts matching the given attributes, case-insensitive on the family.
+        """
+        return [
+            entry
+            for entry in self.entries
+            if (family is None or entry.family.lower() == family.lower())
+            and (weight is None or entry.weight == weight)
+            and (italic is None or entry.italic == italic)
+        ]
+
+    def font_for_text(self, text: str, weight: int = 400) -> FontEntry | None:
+        """
+        Pick a font with a glyph for every character of the text.
+        Upright fonts closest to the requested weight are preferred.
+        :return: The font, or None if no single font covers the text
+        """
+        candidates = [entry for entry in self.entries if entry.covers(text)]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda entry: (entry.italic, abs(entry.weight - weight), entry.path),
+        )
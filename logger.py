@@ -1,4 +1,5 @@
 import sys
+import time
 import logging
 
 
@@ -37,21 +38,30 @@ class MyLogger:
     @staticmethod
     def log_apply(func):
         """
-        Decorator to log the application of the effect.
+        Decorator to log and profile the application of the effect.
+        Wall time, CPU time and peak memory of its ffmpeg processes, file sizes and
+        ffmpeg command lines are sent to the metrics sinks.
         :param func: Function to be decorated
         """
+        # Imported here so the logger itself stays light
+        from metrics import Metrics
 
         logger = MyLogger.get_logger("apply_effect")
 
         def wrapper(self, file_path: str, *args, **kwargs):
             if not file_path:
                 raise ValueError("File path must be provided for using effect")
+            name = self.__class__.__name__
+            start = time.perf_counter()
             try:
-                logger.info(f"Applying effect: {self.__class__.__name__}")
-                func(self, file_path, *args, **kwargs)
+                logger.info(f"Applying effect: {name}")
+                with Metrics.measure(name, file_path, [file_path]):
+                    func(self, file_path, *args, **kwargs)
             except Exception as e:
-                logger.error(f"Error applying effect {self.__class__.__name__}: {e}")
+                logger.error(f"Error applying effect {name}: {e}")
                 raise
-            logger.info(f"Effect {self.__class__.__name__} applied successfully")
+            logger.info(
+                f"Effect {name} applied successfully in {time.perf_counter() - start:.2f}s"
+            )
 
         return wrapper
@@ -1,178 +1,177 @@
+"""
+Command line entry point of the lyric video pipeline.
+
+Only the standard library, pydantic and the lightweight project modules are imported
+at startup. torch, yt-dlp, librosa and google-genai are imported by the stages that
+use them, so `--help` and the `render` command skip them entirely. The cold-start
+target for those is COLD_START_TARGET seconds, checked by the "Ready" log line, or
+in detail with `python -X importtime main.py render ...`.
+"""
+
+import time
+
+_STARTED = time.perf_counter()
+
 import os
 import sys
-import shutil
+import argparse
 
-import yt_dlp
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer, util
 
 from logger import MyLogger
-from structures import UserPrompts
-from effects import EditorEffects
-from utils import FontUtils
-from analyzer import SoundAnalyzer
-
-load_dotenv()
-
-my_prompt = UserPrompts(
-    title=os.getenv("TITLE", "Never gonna give you up"),
-    author=os.getenv("AUTHOR", "Rick Astley"),
-    language=os.getenv("LANGUAGE", "en"),
-)
-
-sys.stderr = open("error.log", "w")
-
-logger = MyLogger.get_logger("main")
-logger.info("Loading SentenceTransformer model...")
-model = SentenceTransformer("all-MiniLM-L6-v2")
-embedding1 = model.encode(
-    f"The original video music video called {my_prompt.title} by {my_prompt.author}."
-)
-logger.info("Model loaded successfully.")
-
-ydl_opts = {
-    "skip_download": True,
-    "extract_flat": "in_playlist",
-    "logger": logger,
-}
-
-download_opts = {
-    "http_headers": {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/138.0.0.0 Safari/537.36"
-        ),
-        "Referer": "https://www.youtube.com/",
-    },
-    "outtmpl": "downloads/%(title)s/%(title)s.%(ext)s",
-    "geo_bypass": True,
-    "logger": logger,
-    "subtitleslangs": [my_prompt.language],
-    "subtitlesformat": "srt",
-    "writesubtitles": True,
-    "writeautomaticsub": True,
-    # "verbose": True,
-}
-
-
-with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-    logger.info("Searching for videos...")
-    results = ydl.extract_info(
-        f"ytsearch5:{my_prompt.title} {my_prompt.author}", download=False
-    )
-    logger.info("Search completed.")
-
-    max_entry = None
-    max_metric = -1
-    max_cosine_similarity = -1
-    if results is None:
-        logger.error("No results found.")
-        exit(1)
-
-    max_view = max(entry.get("view_count", 0) for entry in results["entries"])
-    min_view = min(entry.get("view_count", 0) for entry in results["entries"])
-
-    logger.info(f"Max view count: {max_view}, Min view count: {min_view}")
-    for entry in results["entries"]:
-        description = (
-            "Title Video: "
-            + entry.get("title", "No title")
-            + " from channel: "
-            + entry.get("channel", "No uploader")
-            + " with total views: "
-            + str(entry.get("view_count", "Not available"))
-        )
-        embedding2 = model.encode(description)
-
-        # Compute cosine similarity between the embeddings
-        cos_sim = util.cos_sim(embedding1, embedding2)
-
-        # Normalize view_count to a range of 0 to 1
-        current_view_count = entry.get("view_count", 0)
-        normalized_view_count = (current_view_count - min_view) / (max_view - min_view)
-
-        logger.info(
-            f"Video: {entry.get('title', 'No title')}, Channel: {
-                entry.get('channel', 'No uploader')
-            }, Total Views: {
-                entry.get('view_count', 'Not available')
-            }, Normalize View Count : {normalized_view_count:.4f}, Cosine similarity: {
-                cos_sim.item():.4f}"
-        )
-
-        weird_metric = cos_sim.item() * 0.8 + normalized_view_count * 0.2
-        if weird_metric > max_metric:
-            max_metric = weird_metric
-            max_entry = entry
-            max_cosine_similarity = cos_sim.item()
-
-    # Download the video
-    if max_entry:
-        logger.info(
-            f"Best match found: {max_entry.get('title', 'No title')} with cosine similarity {max_cosine_similarity:.4f}, with views: {max_entry.get('view_count', 'Not available')}"
-        )
-        with yt_dlp.YoutubeDL(download_opts) as download_ydl:
-            logger.info(f"Downloading {max_entry['url']}")
-            ret_code = download_ydl.download([max_entry["url"]])
-            if ret_code != 0:
-                logger.error(
-                    f"Failed to download video: {max_entry['url']}, return code: {ret_code}"
-                )
-                exit(1)
-
-            metadata = download_ydl.extract_info(max_entry["url"], download=False)
-            if not metadata:
-                logger.error("Failed to extract metadata from the downloaded video.")
-                exit(1)
-            # Get subtitles
-            # If there is a manual subtitle, use it, discard the automatic one
-            if "subtitles" in metadata and my_prompt.language in metadata["subtitles"]:
-                logger.info(
-                    f"Using manual subtitles for language: {my_prompt.language}"
-                )
-            elif (
-                "automatic_captions" in metadata
-                and my_prompt.language in metadata["automatic_captions"]
-            ):
-                logger.info(
-                    f"Using automatic subtitles for language: {my_prompt.language}"
+from structures import UserPrompts, ENCODER_PROFILES, OUTPUT_FORMATS
+from media_source import LocalSource
+from pipeline import Pipeline, PipelineError
+from tracing import Tracer
+
+COLD_START_TARGET: float = 0.5  # Seconds from importing main to the first stage
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Cut the chorus of a music video into a lyric video."
+    )
+    parser.add_argument(
+        "--title", default=os.getenv("TITLE", "Never gonna give you up")
+    )
+    parser.add_argument("--author", default=os.getenv("AUTHOR", "Rick Astley"))
+    parser.add_argument("--language", default=os.getenv("LANGUAGE", "en"))
+    parser.add_argument(
+        "--analysis-workers",
+        type=int,
+        default=int(os.getenv("ANALYSIS_WORKERS", "1")),
+        help="Processes used to extract the audio features",
+    )
+    parser.add_argument(
+        "--chorus-mode",
+        choices=["llm", "local", "auto"],
+        default=os.getenv("CHORUS_MODE", "auto"),
+    )
+    parser.add_argument(
+        "--search-results",
+        type=int,
+        default=int(os.getenv("SEARCH_RESULTS", "5")),
+        help="Search results ranked per song",
+    )
+    parser.add_argument(
+        "--segment-download",
+        action="store_true",
+        default=os.getenv("SEGMENT_DOWNLOAD", "").lower() in ("1", "true"),
+        help="Download the audio first, then only the chorus of the video",
+    )
+    parser.add_argument(
+        "--media-dir",
+        default=os.getenv("MEDIA_DIR"),
+        help="Serve songs from this directory instead of YouTube",
+    )
+    parser.add_argument(
+        "--render-chunks",
+        type=int,
+        default=int(os.getenv("RENDER_CHUNKS", "1")),
+        help="Chunks of each render encoded in parallel",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(ENCODER_PROFILES),
+        default=os.getenv("ENCODER_PROFILE", "standard"),
+        help="Encoder profile, draft renders a quick downscaled preview",
+    )
+    parser.add_argument(
+        "--formats",
+        choices=list(OUTPUT_FORMATS),
+        nargs="+",
+        default=os.getenv("OUTPUT_FORMATS", "").split() or None,
+        help="Render these aspect ratios from one decode, e.g. 9:16 1:1 16:9",
+    )
+    parser.add_argument(
+        "--fit",
+        choices=["crop", "pad"],
+        default=os.getenv("OUTPUT_FIT", "crop"),
+        help="Crop the video to fill the formats, or pad it to fit",
+    )
+    parser.add_argument(
+        "--trace",
+        default=os.getenv("TRACE_FILE"),
+        help="Write the spans of the run, JSON lines if the path ends with .jsonl, "
+        "Chrome trace otherwise",
+    )
+    commands = parser.add_subparsers(dest="command")
+    parser.set_defaults(command="run")
+
+    commands.add_parser("run", help="Search, download and render a song")
+
+    chorus_parser = commands.add_parser(
+        "chorus", help="Find the chorus of a local video, skipping search"
+    )
+    chorus_parser.add_argument("video")
+    chorus_parser.add_argument("subtitles")
+
+    render_parser = commands.add_parser(
+        "render", help="Render a segment of a local video, skipping search and analysis"
+    )
+    render_parser.add_argument("video")
+    render_parser.add_argument("subtitles")
+    render_parser.add_argument("--start", type=float, required=True)
+    render_parser.add_argument("--end", type=float, required=True)
+    render_parser.add_argument("--output", help="Defaults to <video>_edited.mp4")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    load_dotenv()
+    args = build_parser().parse_args(argv)
+
+    sys.stderr = open("error.log", "w")
+    logger = MyLogger.get_logger("main")
+    logger.info(
+        f"Ready in {time.perf_counter() - _STARTED:.2f}s "
+        f"(target {COLD_START_TARGET:.2f}s)"
+    )
+
+    pipeline = Pipeline(
+        analysis_workers=args.analysis_workers,
+        chorus_mode=args.chorus_mode,
+        search_results=args.search_results,
+        segment_download=args.segment_download,
+        source=LocalSource(args.media_dir) if args.media_dir else None,
+        render_chunks=args.render_chunks,
+        encoder_profile=args.profile,
+        output_formats=args.formats,
+        output_fit=args.fit,
+    )
+    try:
+        match args.command:
+            case "run":
+                pipeline.run(
+                    UserPrompts(
+                        title=args.title, author=args.author, language=args.language
+                    )
                 )
-            else:
-                logger.error(
-                    f"No subtitles found for language: {my_prompt.language}. Exiting."
+            case "chorus":
+                pipeline.choose_chorus(args.video, args.subtitles)
+            case "render":
+                output_path = pipeline.render(
+                    UserPrompts(
+                        title=args.title, author=args.author, language=args.language
+                    ),
+                    args.video,
+                    args.subtitles,
+                    None,
+                    (args.start, args.end),
+                    output_path=args.output,
                 )
-                exit(1)
-
-            file_name = download_ydl.prepare_filename(metadata)
-            base_name = os.path.splitext(file_name)[0]
-            subtitle_file = f"{base_name}.{my_prompt.language}.srt"
-
-            logger.info(f"Downloaded to {file_name}")
-
-            sound_analyzer = SoundAnalyzer(path=file_name)
-            start_chorus, end_chorus = sound_analyzer.pick_chorus(
-                lyrics_path=subtitle_file
-            )
-            logger.info(
-                f"Chorus segment found from {start_chorus:.2f} to {end_chorus:.2f} seconds."
-            )
-
-            edited_filename = os.path.splitext(file_name)[0] + "_edited.mp4"
-            shutil.copy(file_name, edited_filename)
-
-            editor = EditorEffects(
-                file_path=edited_filename,
-                subtitle_path=subtitle_file,
-                metadata=metadata,
-                start_time=start_chorus,
-                duration=end_chorus - start_chorus,
-            )
-            logger.info(f"Using font: {FontUtils.get_current_font()}")
-            editor.effects_vid(user_prompts=my_prompt)
-            editor.add_subtitles()
-
-    else:
-        logger.warning("No suitable video found.")
-
-logger.info("Finished")
+                logger.info(f"Rendered to {output_path}")
+    except PipelineError as e:
+        logger.error(f"{e} Exiting.")
+        return 1
+    finally:
+        if args.trace:
+            Tracer.export(args.trace)
+            logger.info(f"Trace written to {args.trace}")
+
+    logger.info("Finished")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+import os
+import json
+from abc import ABC, abstractmethod
+
+from logger import MyLogger
+from cache import JsonCache
+
+
+class MediaSourceError(Exception):
+    """
+    Raised when a media source cannot provide a video, its metadata or subtitles.
+    """
+
+    ...
+
+
+class MediaSource(ABC):
+    """
+    Where the pipeline finds songs: searches them, and fetches their metadata,
+    media and subtitles. Videos are identified by the url of their search entry.
+    """
+
+    @abstractmethod
+    def search(self, query: str, limit: int) -> list[dict]:
+        """
+        :return: Up to limit search entries with url, title, channel and view_count
+        """
+        ...
+
+    @abstractmethod
+    def fetch_metadata(self, url: str) -> dict:
+        """
+        :return: Metadata of the video, in the yt-dlp info dict format
+        """
+        ...
+
+    @abstractmethod
+    def fetch_media(
+        self,
+        url: str,
+        language: str | None = None,
+        audio_only: bool = False,
+        section: tuple[float, float] | None = None,
+    ) -> tuple[str, float]:
+        """
+        :param language: Subtitle language to fetch along with the media, if any
+        :param audio_only: Only the audio is needed
+        :param section: (start, end) in seconds, only this part is needed
+        :return: (file path, time of the video at which the file starts), a section
+            may start before the requested start
+        """
+        ...
+
+    @abstractmethod
+    def fetch_subtitles(self, url: str, language: str) -> str:
+        """
+        :return: Path to the SRT subtitles of the video in the language
+        """
+        ...
+
+
+class YouTubeSource(MediaSource):
+    """
+    Searches and downloads from YouTube with yt-dlp.
+    Search results, metadata and downloaded files are cached, so repeated
+    requests for the same song make no network request.
+    """
+
+    USER_AGENT: str = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/138.0.0.0 Safari/537.36"
+    )
+    SEARCH_TTL: float = float(os.getenv("SEARCH_CACHE_TTL", 24 * 3600))
+    METADATA_TTL: float = float(os.getenv("METADATA_CACHE_TTL", 7 * 24 * 3600))
+    OUTTMPL: str = "downloads/%(title)s/%(title)s.%(ext)s"
+
+    def __init__(self):
+        self.logger = MyLogger.get_logger("main")
+        self.search_cache = JsonCache(
+            os.getenv("SEARCH_CACHE_DIR", os.path.join(".cache", "search")),
+            ttl=self.SEARCH_TTL,
+        )
+        self.metadata_cache = JsonCache(
+            os.getenv("METADATA_CACHE_DIR", os.path.join(".cache", "metadata")),
+            ttl=self.METADATA_TTL,
+        )
+
+    def _opts(self, **opts) -> dict:
+        return {
+            "http_headers": {
+                "User-Agent": self.USER_AGENT,
+                "Referer": "https://www.youtube.com/",
+            },
+            "outtmpl": self.OUTTMPL,
+            "geo_bypass": True,
+            "logger": self.logger,
+            # "verbose": True,
+            **opts,
+        }
+
+    @staticmethod
+    def _subtitle_opts(language: str) -> dict:
+        return {
+            "subtitleslangs": [language],
+            "subtitlesformat": "srt",
+            "writesubtitles": True,
+            "writeautomaticsub": True,
+        }
+
+    def _cached_file(self, *parts: str) -> str | None:
+        cached = self.metadata_cache.get(JsonCache.key(*parts))
+        if cached is not None and os.path.exists(cached["file_name"]):
+            return cached["file_name"]
+        return None
+
+    @staticmethod
+    def _file_start(file_name: str, section: tuple[float, float] | None) -> float:
+        """
+        Time of the video at which a downloaded file starts. A stream copied section
+        keeps its timestamps relative to the requested start, those of the frames
+        from the keyframe before it are negative.
+        """
+        if not section:
+            return 0.0
+        from utils import StreamUtils
+
+        return section[0] + StreamUtils.get_start_time(file_name)
+
+    def _extract(self, opts: dict, url: str, download: bool) -> dict:
+        import yt_dlp
+
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            try:
+                info = ydl.extract_info(url, download=download)
+            except yt_dlp.utils.DownloadError as e:
+                raise MediaSourceError(f"Failed to download {url}, {e}") from e
+            if not info:
+                raise MediaSourceError(f"Failed to extract metadata from {url}.")
+            return ydl.sanitize_info(info)
+
+    def _save_subtitles(self, url: str, info: dict, language: str):
+        subtitle = (info.get("requested_subtitles") or {}).get(language)
+        if subtitle and subtitle.get("filepath"):
+            self.metadata_cache.put(
+                JsonCache.key("subtitles", url, language),
+                {"file_name": subtitle["filepath"]},
+            )
+
+    def search(self, query: str, limit: int) -> list[dict]:
+        search_url = f"ytsearch{limit}:{query}"
+        cache_key = JsonCache.key("search", search_url)
+        results = self.search_cache.get(cache_key)
+        if results is not None:
+            self.logger.info(f"Using cached search results for {search_url}")
+        else:
+            self.logger.info("Searching for videos...")
+            results = self._extract(
+                {"skip_download": True, "extract_flat": "in_playlist", "logger": self.logger},
+                search_url,
+                download=False,
+            )
+            self.logger.info("Search completed.")
+            self.search_cache.put(cache_key, results)
+        return list(results.get("entries") or [])
+
+    def fetch_metadata(self, url: str) -> dict:
+        cache_key = JsonCache.key("video", url)
+        metadata = self.metadata_cache.get(cache_key)
+        if metadata is None:
+            metadata = self._extract(self._opts(), url, download=False)
+            self.metadata_cache.put(cache_key, metadata)
+        return metadata
+
+    def fetch_media(
+        self,
+        url: str,
+        language: str | None = None,
+        audio_only: bool = False,
+        section: tuple[float, float] | None = None,
+    ) -> tuple[str, float]:
+        import yt_dlp
+
+        parts = ["media", url, "audio" if audio_only else "video"]
+        if section:
+            parts += [f"{section[0]:.3f}", f"{section[1]:.3f}"]
+        file_name = self._cached_file(*parts)
+        if file_name is not None and (
+            language is None or self._cached_file("subtitles", url, language)
+        ):
+            self.logger.info(f"Using cached download {file_name}")
+            return file_name, self._file_start(file_name, section)
+
+        opts = self._opts()
+        if language is not None:
+            opts.update(self._subtitle_opts(language))
+        if audio_only:
+            opts["format"] = "bestaudio/best"
+            opts["outtmpl"] = "downloads/%(title)s/%(title)s.audio.%(ext)s"
+        if section:
+            opts["outtmpl"] = (
+                "downloads/%(title)s/%(title)s.%(section_start)d-%(section_end)d.%(ext)s"
+            )
+            # Stream copied, so the chorus is only encoded once, by the render.
+            # The cut falls on a keyframe, _file_start finds where it actually is
+            opts["download_ranges"] = yt_dlp.utils.download_range_func(None, [section])
+
+        self.logger.info(
+            f"Downloading {url}"
+            + (f" from {section[0]:.2f} to {section[1]:.2f}s" if section else "")
+        )
+        # One request for the download and its metadata
+        info = self._extract(opts, url, download=True)
+        if not info.get("requested_downloads"):
+            raise MediaSourceError(f"Nothing downloaded for {url}.")
+        file_name = info["requested_downloads"][0]["filepath"]
+
+        self.metadata_cache.put(JsonCache.key(*parts), {"file_name": file_name})
+        if not section:
+            self.metadata_cache.put(JsonCache.key("video", url), info)
+        if language is not None:
+            self._save_subtitles(url, info, language)
+        self.logger.info(f"Downloaded to {file_name}")
+        return file_name, self._file_start(file_name, section)
+
+    def fetch_subtitles(self, url: str, language: str) -> str:
+        metadata = self.fetch_metadata(url)
+        # If there is a manual subtitle, use it, discard the automatic one
+        if language in (metadata.get("subtitles") or {}):
+            self.logger.info(f"Using manual subtitles for language: {language}")
+        elif language in (metadata.get("automatic_captions") or {}):
+            self.logger.info(f"Using automatic subtitles for language: {language}")
+        else:
+            raise MediaSourceError(f"No subtitles found for language: {language}.")
+
+        file_name = self._cached_file("subtitles", url, language)
+        if file_name is None:
+            info = self._extract(
+                self._opts(skip_download=True, **self._subtitle_opts(language)),
+                url,
+                download=True,
+            )
+            self._save_subtitles(url, info, language)
+            file_name = self._cached_file("subtitles", url, language)
+            if file_name is None:
+                raise MediaSourceError(f"Failed to download {language} subtitles of {url}.")
+        return file_name
+
+
+class LocalSource(MediaSource):
+    """
+    Serves songs from a directory tree, without network access.
+
+    Every song is a subdirectory holding its media files, its subtitles named
+    "<name>.<language>.srt" and optionally the yt-dlp metadata "<name>.info.json".
+    Songs are identified by the webpage_url of their metadata, so recorded jobs
+    can be replayed, or by "local:<directory name>".
+    """
+
+    MEDIA_EXTENSIONS: set[str] = {".mp4", ".mkv", ".webm", ".mov"}
+    AUDIO_EXTENSIONS: set[str] = {".m4a", ".mp3", ".opus", ".ogg", ".wav", ".flac"}
+
+    def __init__(self, root: str):
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"Media directory '{root}' does not exist.")
+        self.root = root
+        self.logger = MyLogger.get_logger("main")
+
+    def _song_dirs(self) -> list[str]:
+        return [
+            os.path.join(self.root, name)
+            for name in sorted(os.listdir(self.root))
+            if os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def _read_metadata(self, song_dir: str) -> dict:
+        name = os.path.basename(song_dir)
+        metadata = {}
+        for file in sorted(os.listdir(song_dir)):
+            if file.endswith(".info.json"):
+                with open(os.path.join(song_dir, file), "r", encoding="utf-8") as f:
+                    metadata = json.load(f)
+                break
+        metadata.setdefault("title", name)
+        metadata.setdefault("webpage_url", f"local:{name}")
+        return metadata
+
+    def _song_dir(self, url: str) -> str:
+        for song_dir in self._song_dirs():
+            metadata = self._read_metadata(song_dir)
+            if url in (
+                metadata["webpage_url"],
+                metadata.get("original_url"),
+                f"local:{os.path.basename(song_dir)}",
+            ):
+                return song_dir
+        raise MediaSourceError(f"No song found for {url} in {self.root}.")
+
+    def search(self, query: str, limit: int) -> list[dict]:
+        words = set(query.lower().split())
+        entries = []
+        for song_dir in self._song_dirs():
+            metadata = self._read_metadata(song_dir)
+            text = f"{metadata['title']} {metadata.get('channel') or ''}".lower()
+            entries.append(
+                (
+                    -sum(word in text for word in words),
+                    {
+                        "url": metadata["webpage_url"],
+                        "title": metadata["title"],
+                        "channel": metadata.get("channel"),
+                        "view_count": metadata.get("view_count"),
+                    },
+                )
+            )
+        entries.sort(key=lambda item: item[0])  # Stable, directory order on ties
+        return [entry for _, entry in entries[:limit]]
+
+    def fetch_metadata(self, url: str) -> dict:
+        return self._read_metadata(self._song_dir(url))
+
+    def fetch_media(
+        self,
+        url: str,
+        language: str | None = None,
+        audio_only: bool = False,
+        section: tuple[float, float] | None = None,
+    ) -> tuple[str, float]:
+        song_dir = self._song_dir(url)
+        videos, audios = [], []
+        for file in sorted(os.listdir(song_dir)):
+            stem, ext = os.path.splitext(file)
+            if stem.endswith("_edited"):
+                continue  # Rendered by a previous run
+            if ext.lower() in self.MEDIA_EXTENSIONS:
+                videos.append(os.path.join(song_dir, file))
+            elif ext.lower() in self.AUDIO_EXTENSIONS:
+                audios.append(os.path.join(song_dir, file))
+
+        candidates = audios + videos if audio_only else videos
+        if not candidates:
+            raise MediaSourceError(f"No media found in {song_dir}.")
+        # The whole file is already local, a section starts at the beginning of it
+        return candidates[0], 0.0
+
+    def fetch_subtitles(self, url: str, language: str) -> str:
+        song_dir = self._song_dir(url)
+        for file in sorted(os.listdir(song_dir)):
+            if file.endswith(f".{language}.srt"):
+                return os.path.join(song_dir, file)
+        raise MediaSourceError(f"No subtitles found for language: {language}.")
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Iterator, Sequence
+
+import numpy as np
+from pydantic import BaseModel
+
+from tracing import Tracer
+
+
+class EffectMetrics(BaseModel):
+    """
+    Cost of one application of an effect, or of a render.
+    """
+
+    effect: str
+    wall_time: float  # Seconds
+    child_cpu_time: float | None = None  # User and system seconds of its ffmpeg runs
+    peak_child_rss: int | None = None  # Bytes, peak of its largest ffmpeg process
+    input_size: int  # Bytes of the file before the effect
+    output_size: int  # Bytes of the files written
+    commands: list[str] = []  # ffmpeg command lines run by the effect
+    error: str | None = None
+
+
+class MetricsSink(ABC):
+    """
+    Receives the metrics of every effect application.
+    """
+
+    @abstractmethod
+    def record(self, metrics: EffectMetrics): ...
+
+
+class MetricsAggregator(MetricsSink):
+    """
+    Keeps the metrics in memory and summarizes them per effect.
+    """
+
+    FIELDS: tuple[str, ...] = (
+        "wall_time",
+        "child_cpu_time",
+        "peak_child_rss",
+        "input_size",
+        "output_size",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: dict[str, list[EffectMetrics]] = {}
+
+    def record(self, metrics: EffectMetrics):
+        with self._lock:
+            self._records.setdefault(metrics.effect, []).append(metrics)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def summary(
+        self, percentiles: tuple[float, ...] = (50, 90, 99)
+    ) -> dict[str, dict]:
+        """
+        Percentiles of every field per effect.
+        :return: {effect: {"count", "errors", field: {"p50": ..., ...}}}
+        """
+        with self._lock:
+            records = {effect: list(items) for effect, items in self._records.items()}
+
+        summary = {}
+        for effect, items in records.items():
+            effect_summary: dict = {
+                "count": len(items),
+                "errors": sum(item.error is not None for item in items),
+            }
+            for field in self.FIELDS:
+                values = [
+                    getattr(item, field)
+                    for item in items
+                    if getattr(item, field) is not None
+                ]
+                if not values:
+                    continue
+                effect_summary[field] = {
+                    f"p{percentile:g}": float(value)
+                    for percentile, value in zip(
+                        percentiles, np.percentile(values, percentiles)
+                    )
+                }
+            summary[effect] = effect_summary
+        return summary
+
+
+class JsonlMetricsSink(MetricsSink):
+    """
+    Appends every record as a JSON line to a file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, metrics: EffectMetrics):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(metrics.model_dump_json() + "\n")
+
+
+class Metrics:
+    """
+    Dispatches effect metrics to the registered sinks.
+    The in-memory aggregator is always registered.
+    """
+
+    AGGREGATOR = MetricsAggregator()
+    _SINKS: list[MetricsSink] = [AGGREGATOR]
+
+    @staticmethod
+    def add_sink(sink: MetricsSink):
+        Metrics._SINKS.append(sink)
+
+    @staticmethod
+    def remove_sink(sink: MetricsSink):
+        Metrics._SINKS.remove(sink)
+
+    @staticmethod
+    def record(metrics: EffectMetrics):
+        for sink in list(Metrics._SINKS):
+            sink.record(metrics)
+
+    @staticmethod
+    @contextmanager
+    def measure(
+        name: str, input_path: str, output_paths: Sequence[str]
+    ) -> Iterator[dict]:
+        """
+        Record the cost of the enclosed block and of the ffmpeg commands it runs,
+        in a span of the "effect" category.
+        :param input_path: File read by the block
+        :param output_paths: Files written by the block, the input for in-place effects
+        :return: The attributes of the span
+        """
+
+        def file_size(file_path: str) -> int:
+            return os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+        input_size = file_size(input_path)
+        attrs: dict = {}
+        error = None
+        start = time.perf_counter()
+        try:
+            with Tracer.span(name, "effect") as attrs:
+                yield attrs
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            Metrics.record(
+                EffectMetrics(
+                    effect=name,
+                    wall_time=time.perf_counter() - start,
+                    child_cpu_time=attrs.get("cpu_time"),
+                    peak_child_rss=attrs.get("peak_rss"),
+                    input_size=input_size,
+                    output_size=sum(file_size(path) for path in output_paths),
+                    commands=attrs.get("commands", []),
+                    error=error,
+                )
+            )
+
+    @staticmethod
+    def summary_json(percentiles: tuple[float, ...] = (50, 90, 99)) -> str:
+        return json.dumps(Metrics.AGGREGATOR.summary(percentiles), indent=2)
@@ -0,0 +1,310 @@
+import os
+import threading
+from typing import TYPE_CHECKING, Literal
+
+from logger import MyLogger
+from tracing import Tracer
+from structures import UserPrompts, OutputTarget
+from cache import FeatureCache, JsonCache
+from ranking import CandidateRanker
+from embedding_worker import DEFAULT_MODEL, DEFAULT_SOCKET, EmbeddingClient
+from media_source import MediaSource, MediaSourceError, YouTubeSource
+
+# Heavy dependencies (torch, yt-dlp, librosa, google-genai) are imported by the
+# stages that need them, so importing the pipeline or running a single stage stays fast
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from analyzer import SoundAnalyzer
+
+
+class PipelineError(Exception):
+    """
+    Raised when a song cannot make it through a pipeline stage.
+    """
+
+    ...
+
+
+class Pipeline:
+    """
+    The stages turning a song request into a lyric video:
+    search, download, analyze, choose chorus and render.
+    Each stage can be called on its own, run() chains them for one song.
+    The embedding model is loaded once and shared by every song.
+    """
+
+    SEGMENT_MARGIN: float = 2.0  # Seconds of video kept around the chorus
+
+    def __init__(
+        self,
+        analysis_workers: int = 1,
+        chorus_mode: str = "auto",
+        search_results: int = CandidateRanker.SEARCH_RESULTS,
+        similarity_weight: float = CandidateRanker.SIMILARITY_WEIGHT,
+        views_weight: float = CandidateRanker.VIEWS_WEIGHT,
+        embedding_socket: str = DEFAULT_SOCKET,
+        segment_download: bool = False,
+        segment_margin: float = SEGMENT_MARGIN,
+        source: MediaSource | None = None,
+        render_chunks: int = 1,
+        encoder_profile: str = "standard",
+        output_formats: list[str] | None = None,
+        output_fit: Literal["crop", "pad"] = "crop",
+    ):
+        """
+        :param analysis_workers: Processes used to extract the audio features
+        :param chorus_mode: Chorus detection mode, see SoundAnalyzer.pick_chorus
+        :param search_results: Number of search results ranked per song
+        :param similarity_weight: Ranking weight of the description similarity
+        :param views_weight: Ranking weight of the normalized view count
+        :param embedding_socket: Socket of the embedding worker, if one is running
+        :param segment_download: Download only the audio for the analysis, then only
+            the chorus of the video for the render
+        :param segment_margin: Seconds of video downloaded before and after the chorus
+        :param source: Where songs are searched and downloaded, YouTube by default
+        :param render_chunks: Chunks of the render encoded in parallel
+        :param encoder_profile: Encoder profile of the render, see ENCODER_PROFILES
+        :param output_formats: Aspect ratios rendered from one decode of the video,
+            see OUTPUT_FORMATS, the source geometry is kept if empty
+        :param output_fit: How the video fills the formats, "crop" or "pad"
+        """
+        self.analysis_workers = analysis_workers
+        self.chorus_mode = chorus_mode
+        self.search_results = search_results
+        self.similarity_weight = similarity_weight
+        self.views_weight = views_weight
+        self.logger = MyLogger.get_logger("main")
+        self.feature_cache = FeatureCache()
+        self.response_cache = JsonCache(
+            os.getenv("LLM_CACHE_DIR", os.path.join(".cache", "llm"))
+        )
+        self.embedding_socket = embedding_socket
+        self.segment_download = segment_download
+        self.segment_margin = segment_margin
+        self.source = source or YouTubeSource()
+        self.render_chunks = render_chunks
+        self.encoder_profile = encoder_profile
+        self.output_formats = output_formats or []
+        self.output_fit = output_fit
+        self._model: "SentenceTransformer | EmbeddingClient | None" = None
+        self._model_lock = threading.Lock()
+        self._ranker: CandidateRanker | None = None
+
+    @property
+    def model(self) -> "SentenceTransformer | EmbeddingClient":
+        """
+        The embedding model, served by a running embedding worker if there is one,
+        otherwise loaded in-process.
+        """
+        with self._model_lock:
+            if self._model is None:
+                if EmbeddingClient.available(self.embedding_socket):
+                    self.logger.info(
+                        f"Using embedding worker at {self.embedding_socket}"
+                    )
+                    self._model = EmbeddingClient(self.embedding_socket)
+                else:
+                    from sentence_transformers import SentenceTransformer
+
+                    self.logger.info("Loading SentenceTransformer model...")
+                    self._model = SentenceTransformer(DEFAULT_MODEL)
+                    self.logger.info("Model loaded successfully.")
+            return self._model
+
+    @property
+    def ranker(self) -> CandidateRanker:
+        if self._ranker is None:
+            self._ranker = CandidateRanker(
+                self.model,
+                search_results=self.search_results,
+                similarity_weight=self.similarity_weight,
+                views_weight=self.views_weight,
+            )
+        return self._ranker
+
+    @Tracer.trace("search")
+    def search(self, prompt: UserPrompts) -> dict:
+        """
+        Search for the music video and pick the best match.
+        :return: The search entry of the best match
+        """
+        try:
+            entries = self.source.search(
+                f"{prompt.title} {prompt.author}", self.search_results
+            )
+        except MediaSourceError as e:
+            raise PipelineError(str(e)) from e
+        if not entries:
+            raise PipelineError("No results found.")
+
+        candidates = self.ranker.rank(prompt, entries)
+        for candidate in candidates:
+            self.logger.info(
+                f"Video: {candidate.entry.get('title', 'No title')}, "
+                f"Channel: {candidate.entry.get('channel', 'No uploader')}, "
+                f"Total Views: {candidate.entry.get('view_count', 'Not available')}, "
+                f"Normalize View Count : {candidate.normalized_views:.4f}, "
+                f"Cosine similarity: {candidate.similarity:.4f}"
+            )
+
+        if not candidates:
+            raise PipelineError("No suitable video found.")
+
+        best = candidates[0]
+        self.logger.info(
+            f"Best match found: {best.entry.get('title', 'No title')} with cosine similarity {best.similarity:.4f}, with views: {best.entry.get('view_count', 'Not available')}"
+        )
+        return best.entry
+
+    @Tracer.trace("download")
+    def download(self, prompt: UserPrompts, entry: dict) -> tuple[str, str, dict]:
+        """
+        Download a video and its subtitles in the requested language.
+        With segment downloads, only the audio is downloaded here.
+        :return: (video or audio path, subtitle path, metadata)
+        """
+        url = entry["url"]
+        try:
+            file_name, _ = self.source.fetch_media(
+                url, language=prompt.language, audio_only=self.segment_download
+            )
+            subtitle_file = self.source.fetch_subtitles(url, prompt.language)
+            metadata = self.source.fetch_metadata(url)
+        except MediaSourceError as e:
+            raise PipelineError(str(e)) from e
+        return file_name, subtitle_file, metadata
+
+    @Tracer.trace("download_segment")
+    def download_segment(
+        self, metadata: dict, chorus: tuple[float, float]
+    ) -> tuple[str, float]:
+        """
+        Download only the chorus of a video, with a margin on both sides.
+        :param metadata: Metadata from download
+        :return: (video path, time of the original video at which the file starts)
+        """
+        url = metadata.get("webpage_url") or metadata["original_url"]
+        start = max(0.0, chorus[0] - self.segment_margin)
+        end = chorus[1] + self.segment_margin
+        if metadata.get("duration"):
+            end = min(end, float(metadata["duration"]))
+        try:
+            return self.source.fetch_media(url, section=(start, end))
+        except MediaSourceError as e:
+            raise PipelineError(str(e)) from e
+
+    def render_source(
+        self, file_name: str, metadata: dict | None, chorus: tuple[float, float]
+    ) -> tuple[str, float]:
+        """
+        The video the chorus is rendered from. With segment downloads, only the
+        chorus of the video is downloaded, otherwise it is the downloaded video.
+        :param file_name: Path from download
+        :param metadata: Metadata from download, None for a local video
+        :return: (video path, time of the original video at which the file starts)
+        """
+        if self.segment_download and metadata is not None:
+            return self.download_segment(metadata, chorus)
+        return file_name, 0.0
+
+    def _analyzer(self, file_name: str) -> "SoundAnalyzer":
+        from analyzer import SoundAnalyzer
+
+        return SoundAnalyzer(
+            path=file_name,
+            workers=self.analysis_workers,
+            cache=self.feature_cache,
+            response_cache=self.response_cache,
+        )
+
+    @Tracer.trace("analyze")
+    def analyze(self, file_name: str) -> list[dict]:
+        """
+        Extract the per-second audio features of a video.
+        """
+        return self._analyzer(file_name)._get_features()
+
+    @Tracer.trace("chorus")
+    def choose_chorus(
+        self, file_name: str, subtitle_file: str, features: list[dict] | None = None
+    ) -> tuple[float, float]:
+        """
+        Pick the chorus segment of a video.
+        :param features: Features from analyze, extracted again if not given
+        :return: (start_time, end_time) in seconds
+        """
+        start_chorus, end_chorus = self._analyzer(file_name).pick_chorus(
+            lyrics_path=subtitle_file, mode=self.chorus_mode, features=features
+        )
+        self.logger.info(
+            f"Chorus segment found from {start_chorus:.2f} to {end_chorus:.2f} seconds."
+        )
+        return start_chorus, end_chorus
+
+    @Tracer.trace("render")
+    def render(
+        self,
+        prompt: UserPrompts,
+        file_name: str,
+        subtitle_file: str,
+        metadata: dict | None,
+        chorus: tuple[float, float],
+        output_path: str | None = None,
+        source_offset: float = 0.0,
+    ) -> str:
+        """
+        Render the chorus of a video with its effects and subtitles.
+        :param file_name: Video from render_source
+        :param output_path: Where to write the video, defaults to "<video>_edited.mp4",
+            with output formats "<output>_<format>.mp4" is written for each of them
+        :param source_offset: Time of the original video at which the file starts
+        :return: Path to the rendered video, the first format's with output formats
+        """
+        from effects import EditorEffects
+        from utils import FontUtils
+
+        start_chorus, end_chorus = chorus
+        edited_filename = output_path or os.path.splitext(file_name)[0] + "_edited.mp4"
+        edited_root = os.path.splitext(edited_filename)[0]
+        targets = [
+            OutputTarget.from_format(
+                output_format,
+                f"{edited_root}_{output_format.replace(':', 'x')}.mp4",
+                fit=self.output_fit,
+                profile=self.encoder_profile,
+            )
+            for output_format in self.output_formats
+        ]
+        editor = EditorEffects(
+            file_path=edited_filename,
+            subtitle_path=subtitle_file,
+            metadata=metadata,
+            start_time=start_chorus,
+            duration=end_chorus - start_chorus,
+            source_offset=source_offset,
+            chunk_workers=self.render_chunks,
+            profile=self.encoder_profile,
+            targets=targets,
+        )
+        self.logger.info(f"Using font: {FontUtils.get_current_font()}")
+        editor.render_vid(source_path=file_name, user_prompts=prompt)
+        return targets[0].path if targets else edited_filename
+
+    def run(self, prompt: UserPrompts) -> str:
+        """
+        Run every stage for one song.
+        :return: Path to the rendered video
+        """
+        entry = self.search(prompt)
+        file_name, subtitle_file, metadata = self.download(prompt, entry)
+        features = self.analyze(file_name)
+        chorus = self.choose_chorus(file_name, subtitle_file, features)
+        video_file, source_offset = self.render_source(file_name, metadata, chorus)
+        return self.render(
+            prompt,
+            video_file,
+            subtitle_file,
+            metadata,
+            chorus,
+            source_offset=source_offset,
+        )
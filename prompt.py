@@ -0,0 +1,76 @@
+import math
+
+import numpy as np
+
+
+class FeaturePromptEncoder:
+    """
+    Compact text encoding of the per-second features for the LLM prompt.
+
+    Features are written as one quantized CSV row per time step instead of the repr
+    of the feature dicts. Rows are averaged over groups of seconds when needed so the
+    table fits within a token budget.
+    """
+
+    MAX_TOKENS: int = 6000  # Token budget for the feature table
+    CHARS_PER_TOKEN: float = 3.0  # Conservative estimate for numeric text
+
+    def __init__(self, max_tokens: int = MAX_TOKENS, include_mfcc: bool = True):
+        self.max_tokens = max_tokens
+        self.include_mfcc = include_mfcc
+
+    def estimate_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.CHARS_PER_TOKEN)
+
+    def encode(self, features: list[dict]) -> str:
+        """
+        Encode the features as a table that fits the token budget.
+        :param features: Per-second feature records from SoundAnalyzer
+        :return: The table, preceded by a description of its columns
+        """
+        step = 1
+        while True:
+            text = self._encode(features, step)
+            if self.estimate_tokens(text) <= self.max_tokens or step >= len(features):
+                return text
+            # Grow the step in proportion to the overshoot, at least by one
+            step = max(
+                step + 1,
+                math.ceil(step * self.estimate_tokens(text) / self.max_tokens),
+            )
+
+    def _encode(self, features: list[dict], step: int) -> str:
+        header = (
+            f"Audio features, one row per {step} second(s). "
+            "Columns: start second, rms x1000, zero crossing rate x1000, pitch Hz"
+            + (", 13 MFCCs" if self.include_mfcc else "")
+            + ", chroma as 12 digits 0-9 for C C# D D# E F F# G G# A A# B.\n"
+        )
+        if not features:
+            return header
+
+        seconds = np.array([f["second"] for f in features])
+        rms = np.array([f["rms"] for f in features])
+        zcr = np.array([f["zcr"] for f in features])
+        pitch = np.array([f["pitch"] for f in features])
+        mfcc = np.array([f["mfcc"] for f in features])
+        chroma = np.array([f["chroma"] for f in features])
+
+        rows = []
+        for start in range(0, len(features), step):
+            group = slice(start, start + step)
+            cells = [
+                str(int(seconds[start])),
+                str(round(rms[group].mean() * 1000)),
+                str(round(zcr[group].mean() * 1000)),
+                str(round(pitch[group].mean())),
+            ]
+            if self.include_mfcc:
+                cells.extend(str(round(v)) for v in mfcc[group].mean(axis=0))
+            cells.append(
+                "".join(
+                    str(round(v * 9)) for v in np.clip(chroma[group].mean(axis=0), 0, 1)
+                )
+            )
+            rows.append(",".join(cells))
+        return header + "\n".join(rows)
@@ -0,0 +1,100 @@
+import numpy as np
+from pydantic import BaseModel
+
+from structures import UserPrompts
+
+
+class RankedCandidate(BaseModel):
+    """
+    Represents a search result scored against the requested song.
+    """
+
+    entry: dict  # Search entry from yt-dlp
+    similarity: float  # Cosine similarity between the query and the description
+    normalized_views: float  # View count scaled to [0, 1] among the candidates
+    score: float
+
+
+class CandidateRanker:
+    """
+    Ranks search results by how well they match the requested song.
+
+    The query and every candidate description are embedded in one batched call,
+    and all candidates are scored at once with a weighted sum of the cosine
+    similarity and the min-max normalized view count.
+    """
+
+    SEARCH_RESULTS: int = 5
+    SIMILARITY_WEIGHT: float = 0.8
+    VIEWS_WEIGHT: float = 0.2
+
+    def __init__(
+        self,
+        model,
+        search_results: int = SEARCH_RESULTS,
+        similarity_weight: float = SIMILARITY_WEIGHT,
+        views_weight: float = VIEWS_WEIGHT,
+    ):
+        """
+        :param model: Embedding model with a SentenceTransformer-like encode method
+        :param search_results: Number of search results to rank
+        :param similarity_weight: Weight of the description similarity
+        :param views_weight: Weight of the normalized view count
+        """
+        self.model = model
+        self.search_results = search_results
+        self.similarity_weight = similarity_weight
+        self.views_weight = views_weight
+
+    @staticmethod
+    def query(prompt: UserPrompts) -> str:
+        return f"The original video music video called {prompt.title} by {prompt.author}."
+
+    @staticmethod
+    def describe(entry: dict) -> str:
+        return (
+            "Title Video: "
+            + (entry.get("title") or "No title")
+            + " from channel: "
+            + (entry.get("channel") or "No uploader")
+            + " with total views: "
+            + str(entry.get("view_count") or "Not available")
+        )
+
+    def rank(self, prompt: UserPrompts, entries: list[dict]) -> list[RankedCandidate]:
+        """
+        Score the candidates of a song.
+        :return: The candidates from best to worst
+        """
+        if not entries:
+            return []
+
+        embeddings = np.asarray(
+            self.model.encode(
+                [self.query(prompt)] + [self.describe(entry) for entry in entries],
+                normalize_embeddings=True,
+            )
+        )
+        similarities = embeddings[1:] @ embeddings[0]
+
+        views = np.array(
+            [entry.get("view_count") or 0 for entry in entries], dtype=np.float64
+        )
+        spread = views.max() - views.min()
+        # All candidates equally viewed, views do not tell them apart
+        normalized_views = (
+            (views - views.min()) / spread if spread > 0 else np.zeros_like(views)
+        )
+
+        scores = (
+            self.similarity_weight * similarities + self.views_weight * normalized_views
+        )
+        return [
+            RankedCandidate(
+                entry=entries[i],
+                similarity=float(similarities[i]),
+                normalized_views=float(normalized_views[i]),
+                score=float(scores[i]),
+            )
+            for i in np.argsort(-scores, kind="stable")
+        ]
@@ -6,9 +6,11 @@ from typing import Literal, ClassVar
 
 import ffmpeg
 from pydantic import BaseModel
+from PIL import ImageColor
 
 from utils import StreamUtils, FontUtils
 from logger import MyLogger
+from tracing import Tracer
 
 
 class Segment(BaseModel):
@@ -55,6 +57,142 @@ class EffectType(Enum):
     TEXT_OVERLAY = "text_overlay"
 
 
+class EncoderProfile(BaseModel):
+    """
+    Represents the video encoder settings of a render quality.
+    """
+
+    name: str
+    vcodec: str = "libx264"
+    preset: str = "medium"
+    crf: int | None = 23  # Constant quality, used when no bitrate is set
+    bitrate: str | None = None  # Target video bitrate, e.g. "4M"
+    threads: int = 0  # Encoder threads, 0 lets the encoder decide
+    scale: float = 1.0  # Output resolution relative to the source
+    pix_fmt: str = "yuv420p"
+
+    @staticmethod
+    def get(name: str) -> "EncoderProfile":
+        if name not in ENCODER_PROFILES:
+            raise ValueError(
+                f"Unknown encoder profile '{name}', "
+                f"available: {', '.join(ENCODER_PROFILES)}"
+            )
+        return ENCODER_PROFILES[name]
+
+    def output_args(self) -> dict:
+        """
+        ffmpeg output options of the profile.
+        """
+        args = {
+            "vcodec": self.vcodec,
+            "preset": self.preset,
+            "pix_fmt": self.pix_fmt,
+            "threads": self.threads,
+        }
+        if self.bitrate is not None:
+            args["video_bitrate"] = self.bitrate
+        elif self.crf is not None:
+            args["crf"] = self.crf
+        return args
+
+    def scale_node(
+        self, video_node: ffmpeg.nodes.FilterableStream
+    ) -> ffmpeg.nodes.FilterableStream:
+        """
+        Scale the video to the output resolution, keeping even dimensions for yuv420p.
+        """
+        if self.scale == 1.0:
+            return video_node
+        return video_node.filter(  # type: ignore[reportAttributeAccessIssue]
+            "scale",
+            f"trunc(iw*{self.scale}/2)*2",
+            f"trunc(ih*{self.scale}/2)*2",
+        )
+
+
+ENCODER_PROFILES: dict[str, EncoderProfile] = {
+    # Downscaled preview to check the chorus pick and subtitle layout quickly
+    "draft": EncoderProfile(name="draft", preset="ultrafast", crf=30, scale=0.5),
+    "standard": EncoderProfile(name="standard"),
+    "archival": EncoderProfile(name="archival", preset="slow", crf=16),
+}
+
+
+class OutputTarget(BaseModel):
+    """
+    Represents one output of a multi-output render, e.g. the 9:16 vertical cut.
+    """
+
+    path: str
+    width: int
+    height: int
+    fit: Literal["crop", "pad"] = "crop"  # Fill the frame and crop, or fit and pad
+    profile: str = "standard"  # Encoder profile of the output, see ENCODER_PROFILES
+    pad_color: str = "black"
+
+    @staticmethod
+    def from_format(
+        output_format: str,
+        path: str,
+        fit: Literal["crop", "pad"] = "crop",
+        profile: str = "standard",
+    ) -> "OutputTarget":
+        """
+        :param output_format: Aspect ratio from OUTPUT_FORMATS, e.g. "9:16"
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unknown output format '{output_format}', "
+                f"available: {', '.join(OUTPUT_FORMATS)}"
+            )
+        width, height = OUTPUT_FORMATS[output_format]
+        return OutputTarget(
+            path=path, width=width, height=height, fit=fit, profile=profile
+        )
+
+    @property
+    def encoder(self) -> EncoderProfile:
+        return EncoderProfile.get(self.profile)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """
+        Frame size of the output once the profile scale is applied, even for yuv420p.
+        """
+        scale = self.encoder.scale
+        return (
+            int(self.width * scale) // 2 * 2,
+            int(self.height * scale) // 2 * 2,
+        )
+
+    def video_node(
+        self, video_node: ffmpeg.nodes.FilterableStream
+    ) -> ffmpeg.nodes.FilterableStream:
+        """
+        Scale the video to the output frame, cropping or padding what does not fit.
+        """
+        width, height = self.size
+        if self.fit == "crop":
+            video_node = video_node.filter(  # type: ignore[reportAttributeAccessIssue]
+                "scale", width, height, force_original_aspect_ratio="increase"
+            ).filter("crop", width, height)
+        else:
+            video_node = video_node.filter(  # type: ignore[reportAttributeAccessIssue]
+                "scale", width, height, force_original_aspect_ratio="decrease"
+            ).filter(
+                "pad", width, height, "(ow-iw)/2", "(oh-ih)/2", color=self.pad_color
+            )
+        return video_node.filter("setsar", 1)
+
+
+OUTPUT_FORMATS: dict[str, tuple[int, int]] = {
+    "9:16": (1080, 1920),  # Vertical, shorts and stories
+    "1:1": (1080, 1080),
+    "16:9": (1920, 1080),
+}
+
+
 class Effect(BaseModel, ABC):
     """
     A base class for all effects.
@@ -67,6 +205,12 @@ class Effect(BaseModel, ABC):
         "-stats",  # Show progress stats
     ]
 
+    profile: str = "standard"  # Encoder profile of the passes, see ENCODER_PROFILES
+
+    @property
+    def encoder(self) -> EncoderProfile:
+        return EncoderProfile.get(self.profile)
+
     def __init_subclass__(cls):
         """
         Automatically log the application of the effect when a subclass is created.
@@ -94,6 +238,14 @@ class Effect(BaseModel, ABC):
         """
         ...
 
+    def shifted(self, offset: float) -> "Effect":
+        """
+        The effect for a part of the video starting offset seconds later,
+        e.g. one chunk of a chunked render. Time-invariant effects return themselves.
+        :param offset: Seconds between the start of the video and the start of the part
+        """
+        return self
+
 
 class BlurEffect(Effect):
     """
@@ -120,21 +272,22 @@ class BlurEffect(Effect):
         acodec = "copy" if audio_codec == "aac" else "aac"
 
         with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-            (
+            stream = (
                 ffmpeg.output(
                     video_node,
                     audio_node,
                     temp_file.name,
-                    vcodec="libx264",
                     acodec=acodec,
+                    **self.encoder.output_args(),
                 )
                 .overwrite_output()
                 .global_args(
                     *self.GLOBAL_ARGS  # Use global arguments for ffmpeg
                 )
-                .run()
             )
+            Tracer.run_ffmpeg(stream, self.__class__.__name__)
             os.replace(temp_file.name, file_path)
+            StreamUtils.invalidate(file_path)
 
 
 class TextPosition(BaseModel):
@@ -152,12 +305,53 @@ class TextOverlayProperties(BaseModel):
     background_color: str = "0x00000000"  # Default transparent background color
     start_time: float | None = None  # Start time in seconds for the text overlay
     duration: int = 3  # Duration in seconds for which the text is displayed
+    font_path: str | None = None  # Font of the text, the current font if None
 
     offset: tuple[int, int] = (
         0,
         0,
     )  # Offset for the text overlay (move right, move down) in pixels
 
+    def shifted(self, offset: float) -> "TextOverlayProperties":
+        """
+        The same text for a part of the video starting offset seconds later.
+        """
+        return self.model_copy(update={"start_time": (self.start_time or 0) - offset})
+
+    def layout(self, width: int, height: int) -> tuple[float, float]:
+        """
+        Compute the top-left corner of the text on a frame.
+        :param width: Frame width in pixels
+        :param height: Frame height in pixels
+        :return: (x, y) in pixels, offset included
+        """
+        font_width, font_height = FontUtils.get_font_dimensions(
+            self.font_size, self.text, self.font_path
+        )
+
+        if isinstance(self.position, TextPosition):
+            match self.position.horizontal:
+                case "left":
+                    x = 0
+                case "center":
+                    x = (width - font_width) / 2
+                case "right":
+                    x = width - font_width
+            match self.position.vertical:
+                case "top":
+                    y = 0
+                case "center":
+                    y = (height - font_height) / 2
+                case "bottom":
+                    y = height - font_height
+        else:
+            x = self.position[0]
+            y = self.position[1]
+
+        x += self.offset[0]  # Move right
+        y += self.offset[1]  # Move down
+        return x, y
+
 
 class TextOverlayEffect(Effect):
     """
@@ -165,6 +359,7 @@ class TextOverlayEffect(Effect):
     """
 
     texts: list[TextOverlayProperties]
+    frame_size: tuple[int, int] | None = None  # Laid out for the video size if None
 
     _temp_files: list[str] = []  # List to keep track of temporary files created
 
@@ -175,42 +370,19 @@ class TextOverlayEffect(Effect):
         if not file_path:
             raise ValueError("File path must be provided for video node processing.")
         video_node = input_stream_video
+        width, height = self.frame_size or StreamUtils.get_video_dimensions(file_path)
         for text_props in self.texts:
             if text_props.start_time is None:
                 start_time = StreamUtils.get_start_time(file_path) or 0
             else:
                 start_time = text_props.start_time
 
-            width, height = StreamUtils.get_video_dimensions(file_path)
-            font_width, font_height = FontUtils.get_font_dimensions(
-                text_props.font_size, text_props.text
-            )
-
-            if isinstance(text_props.position, TextPosition):
-                match text_props.position.horizontal:
-                    case "left":
-                        x = 0
-                    case "center":
-                        x = (width - font_width) / 2
-                    case "right":
-                        x = width - font_width
-                match text_props.position.vertical:
-                    case "top":
-                        y = 0
-                    case "center":
-                        y = (height - font_height) / 2
-                    case "bottom":
-                        y = height - font_height
-            else:
-                x = text_props.position[0]
-                y = text_props.position[1]
-
-            x += text_props.offset[0]  # Move right
-            y += text_props.offset[1]  # Move down
+            x, y = text_props.layout(width, height)
 
             extra_args = {}
-            if FontUtils._CURRENT_FONT is not None:
-                extra_args["fontfile"] = FontUtils._CURRENT_FONT
+            font_path = text_props.font_path or FontUtils._CURRENT_FONT
+            if font_path is not None:
+                extra_args["fontfile"] = font_path
 
             video_node = video_node.filter(  # type: ignore[reportAttributeAccessIssue]
                 "drawtext",
@@ -227,6 +399,11 @@ class TextOverlayEffect(Effect):
 
         return video_node
 
+    def shifted(self, offset: float) -> "TextOverlayEffect":
+        return self.model_copy(
+            update={"texts": [text_props.shifted(offset) for text_props in self.texts]}
+        )
+
     def apply(self, file_path: str):
         """
         Apply the text overlay effect to the video file.
@@ -241,21 +418,206 @@ class TextOverlayEffect(Effect):
 
         with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
             # Use ffmpeg to add text overlay
-            (
+            stream = (
                 ffmpeg.output(
                     video_node,
                     audio_node,
                     temp_file.name,
-                    vcodec="libx264",
                     acodec=acodec,
+                    **self.encoder.output_args(),
                 )
                 .overwrite_output()
                 .global_args(
                     *self.GLOBAL_ARGS  # Use global arguments for ffmpeg
                 )
-                .run()
             )
+            Tracer.run_ffmpeg(stream, self.__class__.__name__)
             os.replace(temp_file.name, file_path)
+            StreamUtils.invalidate(file_path)
+
+
+class AssSubtitleEffect(Effect):
+    """
+    Represents text overlays burned in from a single styled ASS subtitle track.
+    Lines are laid out exactly like TextOverlayEffect, but ffmpeg renders them all
+    through one ass filter instead of evaluating one drawtext filter per line.
+    """
+
+    texts: list[TextOverlayProperties]
+    ass_path: str | None = None  # Where the ASS document is written for the filter
+    frame_size: tuple[int, int] | None = None  # Laid out for the video size if None
+
+    @staticmethod
+    def _ass_color(color: str) -> str:
+        """
+        Convert an ffmpeg color ("white", "0xRRGGBB[AA]", "#RRGGBB", "red@0.5")
+        to an ASS color "&HAABBGGRR", where ASS alpha 00 is opaque.
+        """
+        base, _, opacity = color.partition("@")
+        if base.lower().startswith(("0x", "#")):
+            hex_color = base[2:] if base.lower().startswith("0x") else base[1:]
+            red, green, blue = (int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
+            alpha = int(hex_color[6:8], 16) if len(hex_color) == 8 else 255
+        else:
+            red, green, blue = ImageColor.getrgb(base)[:3]
+            alpha = 255
+        if opacity:
+            alpha = round(alpha * float(opacity))
+        return f"&H{255 - alpha:02X}{blue:02X}{green:02X}{red:02X}"
+
+    @staticmethod
+    def _ass_time(seconds: float) -> str:
+        centiseconds = round(max(seconds, 0) * 100)
+        hours, centiseconds = divmod(centiseconds, 360000)
+        minutes, centiseconds = divmod(centiseconds, 6000)
+        secs, centiseconds = divmod(centiseconds, 100)
+        return f"{hours}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
+
+    @staticmethod
+    def _ass_text(text: str) -> str:
+        return (
+            text.replace("{", "\\{").replace("}", "\\}").replace("\n", "\\N")
+        )
+
+    def document(self, file_path: str) -> str:
+        """
+        Build the ASS document for a video, one pixel per PlayRes unit.
+        :param file_path: Path to the video the subtitles are burned into
+        """
+        width, height = self.frame_size or StreamUtils.get_video_dimensions(file_path)
+
+        styles: dict[tuple[str, float, str, str], str] = {}
+        events = []
+        for text_props in self.texts:
+            if text_props.start_time is None:
+                start_time = StreamUtils.get_start_time(file_path) or 0
+            else:
+                start_time = text_props.start_time
+            x, y = text_props.layout(width, height)
+
+            font_path = text_props.font_path or FontUtils.get_current_font()
+            origin_x, origin_y = FontUtils.get_ass_text_origin(
+                text_props.font_size, text_props.text, font_path
+            )
+            x, y = x - origin_x, y - origin_y
+            style_key = (
+                FontUtils.get_font_name(font_path),
+                FontUtils.get_ass_font_size(text_props.font_size, font_path),
+                text_props.color,
+                text_props.background_color,
+            )
+            if style_key not in styles:
+                styles[style_key] = f"S{len(styles)}"
+            events.append(
+                f"Dialogue: 0,{self._ass_time(start_time)},"
+                f"{self._ass_time(start_time + text_props.duration)},"
+                f"{styles[style_key]},,0,0,0,,"
+                f"{{\\pos({round(x)},{round(y)})}}{self._ass_text(text_props.text)}"
+            )
+
+        # Alignment 7 anchors \pos at the top-left corner of the line box,
+        # BorderStyle 3 draws the background box drawtext draws with box=1
+        style_lines = [
+            f"Style: {name},{font_name},{font_size},{self._ass_color(color)},"
+            f"{self._ass_color(color)},{self._ass_color(background_color)},"
+            f"{self._ass_color(background_color)},0,0,0,0,100,100,0,0,3,0,0,7,0,0,0,1"
+            for (font_name, font_size, color, background_color), name in styles.items()
+        ]
+        return "\n".join(
+            [
+                "[Script Info]",
+                "ScriptType: v4.00+",
+                f"PlayResX: {width}",
+                f"PlayResY: {height}",
+                "WrapStyle: 2",
+                "ScaledBorderAndShadow: yes",
+                "",
+                "[V4+ Styles]",
+                "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
+                "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
+                "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+                "Alignment, MarginL, MarginR, MarginV, Encoding",
+                *style_lines,
+                "",
+                "[Events]",
+                "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, "
+                "Effect, Text",
+                *events,
+                "",
+            ]
+        )
+
+    def video_node(
+        self, input_stream_video: ffmpeg.nodes.FilterableStream, *args, **kwargs
+    ):
+        file_path = args[0] if args else kwargs.get("file_path", None)
+        if not file_path:
+            raise ValueError("File path must be provided for video node processing.")
+        if not self.ass_path:
+            raise ValueError("ASS path must be provided for video node processing.")
+
+        with open(self.ass_path, "w", encoding="utf-8") as f:
+            f.write(self.document(file_path))
+
+        return input_stream_video.filter(  # type: ignore[reportAttributeAccessIssue]
+            "ass",
+            filename=self.ass_path,
+            fontsdir=os.path.dirname(FontUtils.get_current_font()),
+        )
+
+    def shifted(self, offset: float) -> "AssSubtitleEffect":
+        """
+        The subtitles of a part of the video, written to their own ASS file.
+        """
+        ass_path = self.ass_path
+        if ass_path is not None:
+            ass_path = f"{os.path.splitext(ass_path)[0]}.{offset:.3f}.ass"
+        return self.model_copy(
+            update={
+                "texts": [text_props.shifted(offset) for text_props in self.texts],
+                "ass_path": ass_path,
+            }
+        )
+
+    def apply(self, file_path: str):
+        """
+        Apply the subtitles to the video file.
+        :param file_path: Path to the input video file
+        """
+        audio_codec = StreamUtils.get_audio_codec(file_path)
+        acodec = "copy" if audio_codec == "aac" else "aac"
+
+        ass_path = self.ass_path
+        if ass_path is None:
+            with tempfile.NamedTemporaryFile(suffix=".ass", delete=False) as ass_file:
+                self.ass_path = ass_file.name
+
+        try:
+            input_stream = ffmpeg.input(file_path)
+            video_node = self.video_node(input_stream.video, file_path)
+            audio_node = input_stream.audio
+
+            with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+                stream = (
+                    ffmpeg.output(
+                        video_node,
+                        audio_node,
+                        temp_file.name,
+                        acodec=acodec,
+                        **self.encoder.output_args(),
+                    )
+                    .overwrite_output()
+                    .global_args(
+                        *self.GLOBAL_ARGS  # Use global arguments for ffmpeg
+                    )
+                )
+                Tracer.run_ffmpeg(stream, self.__class__.__name__)
+                os.replace(temp_file.name, file_path)
+                StreamUtils.invalidate(file_path)
+        finally:
+            if ass_path is None:
+                os.remove(self.ass_path)
+                self.ass_path = None
 
 
 class TrimEffect(Effect):
@@ -281,16 +643,17 @@ class TrimEffect(Effect):
         acodec = "copy" if audio_codec == "aac" else "aac"
 
         with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-            (
+            stream = (
                 ffmpeg.input(file_path, ss=self.start_time, to=self.end_time)
                 .output(temp_file.name, vcodec="copy", acodec=acodec)
                 .overwrite_output()
                 .global_args(
                     *self.GLOBAL_ARGS  # Use global arguments for ffmpeg
                 )
-                .run()
             )
+            Tracer.run_ffmpeg(stream, self.__class__.__name__)
             os.replace(temp_file.name, file_path)
+            StreamUtils.invalidate(file_path)
 
 
 class FillOverlayEffect(Effect):
@@ -338,19 +701,19 @@ class FillOverlayEffect(Effect):
         acodec = "copy" if audio_codec == "aac" else "aac"
 
         with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-            (
+            stream = (
                 ffmpeg.output(
                     video_node,
                     audio_node,
                     temp_file.name,
-                    vcodec="libx264",
                     acodec=acodec,
-                    pix_fmt="yuv420p",
+                    **self.encoder.output_args(),
                 )
                 .overwrite_output()
                 .global_args(
                     *self.GLOBAL_ARGS  # Use global arguments for ffmpeg
                 )
-                .run()
             )
+            Tracer.run_ffmpeg(stream, self.__class__.__name__)
             os.replace(temp_file.name, file_path)
+            StreamUtils.invalidate(file_path)
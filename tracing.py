@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import functools
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator
+
+import ffmpeg
+from pydantic import BaseModel
+
+# Most seconds between two reads of the peak memory of a running ffmpeg process
+RSS_SAMPLE_INTERVAL = 0.05
+
+# Spans kept in memory, the oldest are dropped first so long batches stay bounded
+MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "100000"))
+
+
+class Span(BaseModel):
+    """
+    Represents a timed section of a job, a pipeline stage or an ffmpeg run.
+    """
+
+    name: str
+    category: str  # "stage", "ffmpeg", "llm", ...
+    start: float  # Epoch seconds
+    duration: float  # Seconds
+    thread: str
+    parent: str | None = None  # Name of the enclosing span on the same thread
+    attrs: dict = {}
+
+
+class Tracer:
+    """
+    Records the latest MAX_SPANS spans of every thread in memory and exports them
+    as JSON lines or in the Chrome trace format (chrome://tracing, Perfetto).
+    """
+
+    _SPANS: deque[Span] = deque(maxlen=MAX_SPANS)
+    _LOCK = threading.Lock()
+    _LOCAL = threading.local()
+
+    @staticmethod
+    def _stack() -> list[tuple[str, dict]]:
+        if not hasattr(Tracer._LOCAL, "stack"):
+            Tracer._LOCAL.stack = []
+        return Tracer._LOCAL.stack
+
+    @staticmethod
+    def current() -> dict | None:
+        """
+        :return: The attributes of the innermost open span of this thread, if any
+        """
+        stack = Tracer._stack()
+        return stack[-1][1] if stack else None
+
+    @staticmethod
+    @contextmanager
+    def span(name: str, category: str = "stage", **attrs) -> Iterator[dict]:
+        """
+        Time the enclosed block.
+        :param attrs: Attributes of the span, the yielded dict can add more
+        :return: The attributes of the span
+        """
+        stack = Tracer._stack()
+        parent = stack[-1][0] if stack else None
+        stack.append((name, attrs))
+        start = time.time()
+        start_counter = time.perf_counter()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs["error"] = f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span = Span(
+                name=name,
+                category=category,
+                start=start,
+                duration=time.perf_counter() - start_counter,
+                thread=threading.current_thread().name,
+                parent=parent,
+                attrs=attrs,
+            )
+            with Tracer._LOCK:
+                Tracer._SPANS.append(span)
+
+    @staticmethod
+    def trace(name: str | None = None, category: str = "stage"):
+        """
+        Decorator recording a span for every call of the function.
+        :param name: Span name, defaults to the function name
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Tracer.span(name or func.__name__, category):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def parse_progress(text: str) -> dict:
+        """
+        Parse the last report of ffmpeg -progress output.
+        :return: Metrics among frames, fps, speed, out_time and total_size
+        """
+        report: dict[str, str] = {}
+        for line in text.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                report[key.strip()] = value.strip()
+
+        metrics: dict = {}
+        conversions = {
+            "frame": ("frames", int),
+            "fps": ("fps", float),
+            "total_size": ("total_size", int),
+        }
+        for key, (metric, convert) in conversions.items():
+            try:
+                metrics[metric] = convert(report[key])
+            except (KeyError, ValueError):
+                pass
+        try:
+            metrics["speed"] = float(report["speed"].rstrip("x"))
+        except (KeyError, ValueError):
+            pass
+        try:
+            metrics["out_time"] = int(report["out_time_us"]) / 1e6
+        except (KeyError, ValueError):
+            pass
+        return metrics
+
+    @staticmethod
+    def _peak_rss(pid: int | str = "self") -> int | None:
+        """
+        Get the peak memory of a process in bytes, from its VmHWM.
+        :return: None without procfs, e.g. on macOS, or once the process exited
+        """
+        try:
+            with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def _watch_peak_rss(pid: int, attrs: dict, done: threading.Event):
+        """
+        Sample the peak memory of a running process until done is set, more often
+        at first so that short runs are sampled too.
+        """
+        interval = 0.001
+        while (peak := Tracer._peak_rss(pid)) is not None:
+            attrs["peak_rss"] = peak
+            if done.wait(interval):
+                return
+            interval = min(interval * 2, RSS_SAMPLE_INTERVAL)
+
+    @staticmethod
+    def _run(
+        stream,
+        attrs: dict,
+        capture_stdout: bool = False,
+        capture_stderr: bool = False,
+        input: bytes | None = None,
+        quiet: bool = False,
+        overwrite_output: bool = False,
+    ) -> tuple[bytes | None, bytes | None]:
+        """
+        Same as stream.run, but adds the CPU time of ffmpeg alone to the attributes,
+        reaping it with wait4 where available, and its peak memory where procfs is.
+        """
+        if not hasattr(os, "wait4"):  # Windows
+            return stream.run(
+                capture_stdout=capture_stdout,
+                capture_stderr=capture_stderr,
+                input=input,
+                quiet=quiet,
+                overwrite_output=overwrite_output,
+            )
+
+        process = stream.run_async(
+            pipe_stdin=input is not None,
+            pipe_stdout=capture_stdout,
+            pipe_stderr=capture_stderr,
+            quiet=quiet,
+            overwrite_output=overwrite_output,
+        )
+        # ru_maxrss of the child starts from the high-water mark of this process,
+        # only the memory sampled from procfs or a higher ru_maxrss is ffmpeg's own
+        inherited_rss = Tracer._peak_rss()
+        done = threading.Event()
+        watcher = threading.Thread(
+            target=Tracer._watch_peak_rss,
+            args=(process.pid, attrs, done),
+            daemon=True,
+        )
+        watcher.start()
+        outputs: dict[str, bytes] = {}
+
+        def drain(key: str, pipe):
+            outputs[key] = pipe.read()
+            pipe.close()
+
+        # Both pipes are drained at once, ffmpeg blocks when one of them is full
+        threads = [
+            threading.Thread(target=drain, args=(key, pipe), daemon=True)
+            for key, pipe in (("stdout", process.stdout), ("stderr", process.stderr))
+            if pipe is not None
+        ]
+        for thread in threads:
+            thread.start()
+        if input is not None:
+            try:
+                process.stdin.write(input)
+            except BrokenPipeError:
+                pass  # ffmpeg exited early, its status tells why
+            process.stdin.close()
+        for thread in threads:
+            thread.join()
+
+        if hasattr(os, "waitid"):
+            # Waits for the exit without reaping, the pid cannot be reused while
+            # the watcher still reads its status
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        done.set()
+        watcher.join()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        attrs["cpu_time"] = usage.ru_utime + usage.ru_stime
+        if inherited_rss is not None and usage.ru_maxrss * 1024 > inherited_rss:
+            attrs["peak_rss"] = max(attrs.get("peak_rss", 0), usage.ru_maxrss * 1024)
+
+        out, err = outputs.get("stdout"), outputs.get("stderr")
+        if process.returncode:
+            raise ffmpeg.Error("ffmpeg", out, err)
+        return out, err
+
+    @staticmethod
+    def run_ffmpeg(stream, name: str, parent: dict | None = None, **run_kwargs):
+        """
+        Run an ffmpeg command in a span holding its command line, progress metrics,
+        CPU time and peak memory.
+        :param stream: Output stream of ffmpeg-python, ready to run
+        :param name: Span name, e.g. the effect applied
+        :param parent: Attributes of the span accounting for the command, defaults to
+            the innermost span of this thread, given when running on a worker thread
+        :param run_kwargs: Options of stream.run
+        :return: Whatever stream.run returns
+        """
+        with tempfile.NamedTemporaryFile(suffix=".progress", delete=False) as f:
+            progress_path = f.name
+        stream = stream.global_args("-progress", progress_path)
+        cmdline = " ".join(ffmpeg.compile(stream))
+        if parent is None:
+            parent = Tracer.current()
+        try:
+            with Tracer.span(name, "ffmpeg", cmdline=cmdline) as attrs:
+                start = time.perf_counter()
+                try:
+                    return Tracer._run(stream, attrs, **run_kwargs)
+                finally:
+                    with open(progress_path, "r", encoding="utf-8") as f:
+                        attrs.update(Tracer.parse_progress(f.read()))
+                    # ffmpeg reports 0 fps on runs shorter than its first stats period
+                    if attrs.get("frames") and not attrs.get("fps"):
+                        attrs["fps"] = attrs["frames"] / (time.perf_counter() - start)
+                    if parent is not None:
+                        # Lets the enclosing span, e.g. an effect, account for its
+                        # commands, which may run concurrently on worker threads
+                        with Tracer._LOCK:
+                            parent.setdefault("commands", []).append(cmdline)
+                            if "cpu_time" in attrs:
+                                parent["cpu_time"] = (
+                                    parent.get("cpu_time", 0.0) + attrs["cpu_time"]
+                                )
+                            if "peak_rss" in attrs:
+                                parent["peak_rss"] = max(
+                                    parent.get("peak_rss", 0), attrs["peak_rss"]
+                                )
+        finally:
+            os.remove(progress_path)
+
+    @staticmethod
+    def spans() -> list[Span]:
+        with Tracer._LOCK:
+            return list(Tracer._SPANS)
+
+    @staticmethod
+    def clear():
+        with Tracer._LOCK:
+            Tracer._SPANS.clear()
+
+    @staticmethod
+    def export_jsonl(path: str):
+        """
+        Write one JSON span per line.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for span in Tracer.spans():
+                f.write(span.model_dump_json() + "\n")
+
+    @staticmethod
+    def export_chrome(path: str):
+        """
+        Write the spans in the Chrome trace event format.
+        """
+        spans = Tracer.spans()
+        threads = {name: i for i, name in enumerate(dict.fromkeys(s.thread for s in spans))}
+        events: list[dict] = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for name, tid in threads.items()
+        ]
+        events += [
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threads[span.thread],
+                "args": span.attrs,
+            }
+            for span in spans
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    @staticmethod
+    def export(path: str):
+        """
+        Export to JSON lines if the path ends with .jsonl, Chrome trace otherwise.
+        """
+        if path.endswith(".jsonl"):
+            Tracer.export_jsonl(path)
+        else:
+            Tracer.export_chrome(path)
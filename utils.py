@@ -1,11 +1,31 @@
 import os
-import glob
 import platform
 import random
+from functools import lru_cache
 
 from PIL import ImageFont
 
 import ffmpeg
+import numpy as np
+from pydantic import BaseModel
+
+from font_catalog import FontCatalog
+from tracing import Tracer
+
+
+class MediaInfo(BaseModel):
+    """
+    Parsed ffprobe output of a media file.
+    """
+
+    streams: list[dict]
+    format: dict = {}
+
+    def first_stream(self, codec_type: str) -> dict | None:
+        """
+        Get the first stream of a type ("video", "audio", ...), if any.
+        """
+        return next((s for s in self.streams if s["codec_type"] == codec_type), None)
 
 
 class StreamUtils:
@@ -13,6 +33,35 @@ class StreamUtils:
     Utility class for common operations related to video files.
     """
 
+    # Absolute path -> ((mtime_ns, size), probe result)
+    _PROBE_CACHE: dict[str, tuple[tuple[int, int], MediaInfo]] = {}
+
+    @staticmethod
+    def probe(file_path) -> MediaInfo:
+        """
+        Probe a media file, memoized per file.
+        A cached result is reused while the file keeps the same mtime and size.
+        Code writing a file in place should also call invalidate on it.
+        """
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        cached = StreamUtils._PROBE_CACHE.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        info = MediaInfo.model_validate(ffmpeg.probe(path))
+        StreamUtils._PROBE_CACHE[path] = (signature, info)
+        return info
+
+    @staticmethod
+    def invalidate(file_path):
+        """
+        Drop the memoized probe result of a file, after it has been rewritten.
+        """
+        StreamUtils._PROBE_CACHE.pop(os.path.abspath(file_path), None)
+
     @staticmethod
     def convert_to_wav(file_path):
         """
@@ -23,19 +72,123 @@ class StreamUtils:
             raise FileNotFoundError(f"File '{file_path}' does not exist.")
 
         output_file = os.path.splitext(file_path)[0] + ".wav"
-        ffmpeg.input(file_path).output(output_file, format="wav").run(
-            overwrite_output=True, quiet=True
+        Tracer.run_ffmpeg(
+            ffmpeg.input(file_path).output(output_file, format="wav"),
+            "wav_conversion",
+            overwrite_output=True,
+            quiet=True,
         )
         return output_file
 
+    @staticmethod
+    def decode_audio(file_path, sample_rate=None):
+        """
+        Decode the audio of a file to mono float32 PCM in memory.
+        ffmpeg writes raw samples to a pipe, no intermediate file is created.
+        Returns a tuple (samples, sample_rate).
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File '{file_path}' does not exist.")
+
+        if sample_rate is None:
+            sample_rate = StreamUtils.get_audio_sample_rate(file_path)
+
+        out, _ = Tracer.run_ffmpeg(
+            ffmpeg.input(file_path).output(
+                "pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=sample_rate
+            ),
+            "decode_audio",
+            capture_stdout=True,
+            quiet=True,
+        )
+        return np.frombuffer(out, dtype=np.float32), sample_rate
+
+    @staticmethod
+    def stream_audio(file_path, block_size, sample_rate):
+        """
+        Decode the audio of a file to mono float32 PCM, block by block.
+        Yields arrays of at most block_size samples, the last one may be shorter.
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File '{file_path}' does not exist.")
+
+        process = (
+            ffmpeg.input(file_path)
+            .output("pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=sample_rate)
+            .global_args("-hide_banner", "-loglevel", "error")
+            # stderr is left alone, a piped but unread stderr could fill and stall
+            .run_async(pipe_stdout=True)
+        )
+        sample_bytes = np.dtype(np.float32).itemsize
+        try:
+            while True:
+                # Buffered reads only come back short at the end of the stream
+                data = process.stdout.read(block_size * sample_bytes)
+                if not data:
+                    break
+                yield np.frombuffer(
+                    data[: len(data) - len(data) % sample_bytes], dtype=np.float32
+                )
+            if process.wait() != 0:
+                raise ffmpeg.Error("ffmpeg", None, None)
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    @staticmethod
+    def get_duration(file_path):
+        """
+        Get the duration of a media file in seconds, None if unknown.
+        """
+        duration = StreamUtils.probe(file_path).format.get("duration")
+        return float(duration) if duration is not None else None
+
+    @staticmethod
+    def get_frame_rate(file_path):
+        """
+        Get the frame rate of the first video stream, None if unknown.
+        """
+        video_stream = StreamUtils.probe(file_path).first_stream("video")
+        if video_stream is None:
+            raise ValueError(f"File '{file_path}' has no video stream.")
+        for key in ("avg_frame_rate", "r_frame_rate"):
+            # A fraction like "30000/1001", "0/0" when unknown
+            numerator, _, denominator = video_stream.get(key, "0/0").partition("/")
+            if float(numerator or 0) > 0 and float(denominator or 1) > 0:
+                return float(numerator) / float(denominator or 1)
+        return None
+
+    @staticmethod
+    def get_keyframes(file_path, start=0.0, end=None):
+        """
+        Get the timestamps of the video keyframes between start and end.
+        Only keyframes are decoded, and only within the interval.
+        """
+        interval = f"{start}%{end}" if end is not None else f"{start}%"
+        info = ffmpeg.probe(
+            file_path,
+            select_streams="v:0",
+            skip_frame="nokey",
+            show_entries="frame=pts_time",
+            read_intervals=interval,
+        )
+        return [
+            float(frame["pts_time"])
+            for frame in info.get("frames", [])
+            if frame.get("pts_time") not in (None, "N/A")
+        ]
+
     @staticmethod
     def get_video_dimensions(file_path):
         """
         Get the dimensions of a video file.
         Returns a tuple (width, height).
         """
-        probe = ffmpeg.probe(file_path)
-        video_stream = next(s for s in probe["streams"] if s["codec_type"] == "video")
+        video_stream = StreamUtils.probe(file_path).first_stream("video")
+        if video_stream is None:
+            raise ValueError(f"File '{file_path}' has no video stream.")
         width = video_stream["width"]
         height = video_stream["height"]
         return width, height
@@ -45,9 +198,10 @@ class StreamUtils:
         """
         Get the start time of the first video stream in a given file.
         """
-        probe = ffmpeg.probe(file_path)
         # Usually the first video stream
-        video_stream = next(s for s in probe["streams"] if s["codec_type"] == "video")
+        video_stream = StreamUtils.probe(file_path).first_stream("video")
+        if video_stream is None:
+            raise ValueError(f"File '{file_path}' has no video stream.")
         # start_time is a string like "0.000000"
         start_time = float(video_stream.get("start_time", 0))
         return start_time
@@ -57,22 +211,26 @@ class StreamUtils:
         """
         Get the video codec of a given file.
         """
-        probe = ffmpeg.probe(file_path)
-        for stream in probe["streams"]:
-            if stream["codec_type"] == "video":
-                return stream["codec_name"]
-        return None
+        video_stream = StreamUtils.probe(file_path).first_stream("video")
+        return video_stream["codec_name"] if video_stream else None
+
+    @staticmethod
+    def get_audio_sample_rate(file_path):
+        """
+        Get the sample rate of the first audio stream in a given file.
+        """
+        audio_stream = StreamUtils.probe(file_path).first_stream("audio")
+        if audio_stream is None:
+            raise ValueError(f"File '{file_path}' has no audio stream.")
+        return int(audio_stream["sample_rate"])
 
     @staticmethod
     def get_audio_codec(file_path):
         """
         Get the audio codec of a given file.
         """
-        probe = ffmpeg.probe(file_path)
-        for stream in probe["streams"]:
-            if stream["codec_type"] == "audio":
-                return stream["codec_name"]
-        return None
+        audio_stream = StreamUtils.probe(file_path).first_stream("audio")
+        return audio_stream["codec_name"] if audio_stream else None
 
 
 class FontUtils:
@@ -81,23 +239,16 @@ class FontUtils:
     """
 
     _CURRENT_FONT: str | None = None
+    _CATALOG: FontCatalog = FontCatalog("fonts/static")
+    # (path, size) -> loaded font, fonts are parsed from disk once
+    _FONTS: dict[tuple[str, int], ImageFont.FreeTypeFont] = {}
 
     @staticmethod
     def find_all_fonts():
         """
         Get all the fonts in the fonts/static directory.
         """
-        fonts_dir = "fonts/static"
-        if not os.path.exists(fonts_dir):
-            raise FileNotFoundError(f"Fonts directory '{fonts_dir}' does not exist.")
-
-        # Use glob to find all font files in the directory
-        font_files = glob.glob(os.path.join(fonts_dir, "*.*"))
-        # Filter out non-font files based on common font extensions
-        font_extensions = {".ttf", ".otf", ".woff", ".woff2", ".ttc"}
-        return [
-            f for f in font_files if os.path.splitext(f)[1].lower() in font_extensions
-        ]
+        return [entry.path for entry in FontUtils._CATALOG.entries]
 
     # Basename: path (e.g., "Arial.ttf") -> full path (e.g., "/usr/share/fonts/Arial.ttf")
     @staticmethod
@@ -129,22 +280,126 @@ class FontUtils:
 
         return selected_font
 
+    @staticmethod
+    def find_font_for_text(text, weight=400):
+        """
+        Get the path of a font covering every character of the text,
+        the current font when it does. Returns None if no single font covers it.
+        """
+        current_font = FontUtils.get_current_font()
+        for entry in FontUtils._CATALOG.entries:
+            if entry.path == current_font and entry.covers(text):
+                return current_font
+        entry = FontUtils._CATALOG.font_for_text(text, weight)
+        return entry.path if entry else None
+
     # CURRENT_FONT: str = random.choice(list(FONTS_AVAILABLE.values()))
 
+    @staticmethod
+    def get_font(font_size, font_path=None) -> ImageFont.FreeTypeFont:
+        """
+        Get a loaded font, each (path, size) is parsed from disk only once.
+        """
+        if font_path is None:
+            font_path = FontUtils.get_current_font()
+        key = (font_path, font_size)
+        font = FontUtils._FONTS.get(key)
+        if font is None:
+            font = ImageFont.truetype(font_path, font_size)
+            FontUtils._FONTS[key] = font
+        return font
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def get_font_name(font_path):
+        """
+        Get the full name of a font file, e.g. "Oswald Bold", falling back to its
+        family name. Renderers such as libass pick this very file by it, while a
+        family name lets them choose any weight of the family.
+        """
+        from fontTools.ttLib import TTFont
+
+        try:
+            name = TTFont(font_path, lazy=True, fontNumber=0)["name"].getDebugName(4)
+        except Exception:
+            name = None
+        return name or FontUtils.get_font(10, font_path).getname()[0]
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _bbox(font_path, font_size, text):
+        return FontUtils.get_font(font_size, font_path).getbbox(text)
+
+    @staticmethod
+    def _measure(font_path, font_size, text):
+        left, top, right, bottom = FontUtils._bbox(font_path, font_size, text)
+        return right - left, bottom - top
+
     @staticmethod
     def get_font_dimensions(font_size, text, font_path=None):
         """
         Get the dimensions of the text when rendered with the specified font and size.
         """
         if font_path is None:
-            font = ImageFont.truetype(FontUtils.get_current_font(), font_size)
-        else:
-            font = ImageFont.truetype(font_path, font_size)
+            font_path = FontUtils.get_current_font()
+        return FontUtils._measure(font_path, font_size, text)
 
-        bbox = font.getbbox(text)
-        width = bbox[2] - bbox[0]
-        height = bbox[3] - bbox[1]
-        return width, height
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _win_metrics(font_path):
+        """
+        Get the OS/2 win ascent and descent of a font file in ems, (0, 0) without them.
+        """
+        from fontTools.ttLib import TTFont
+
+        try:
+            font = TTFont(font_path, lazy=True, fontNumber=0)
+            units_per_em = font["head"].unitsPerEm
+            os2 = font.get("OS/2")
+            if os2 is not None:
+                return os2.usWinAscent / units_per_em, os2.usWinDescent / units_per_em
+        except Exception:
+            pass
+        return 0.0, 0.0
+
+    @staticmethod
+    def get_ass_font_size(font_size, font_path=None):
+        """
+        Get the ASS font size rendering glyphs as large as font_size does with PIL
+        or drawtext. libass sizes a font so that its OS/2 win ascent plus descent
+        spans the ASS font size, not its em.
+        """
+        if font_path is None:
+            font_path = FontUtils.get_current_font()
+        win_height = sum(FontUtils._win_metrics(font_path)) or 1.0
+        return round(font_size * win_height, 2)
+
+    @staticmethod
+    def get_ass_text_origin(font_size, text, font_path=None):
+        """
+        Get the offset of the top-left corner of the text, as measured by PIL, from
+        the ASS position of a top-left aligned line. libass puts the top of the win
+        ascent of the font there, while PIL measures from its ascender.
+        :return: (x, y) in pixels
+        """
+        if font_path is None:
+            font_path = FontUtils.get_current_font()
+        left, top, _, _ = FontUtils._bbox(font_path, font_size, text)
+        win_ascent, _ = FontUtils._win_metrics(font_path)
+        if win_ascent:
+            ascent, _ = FontUtils.get_font(font_size, font_path).getmetrics()
+            top += win_ascent * font_size - ascent
+        return left, top
+
+    @staticmethod
+    def get_fonts_dimensions(font_size, texts, font_path=None):
+        """
+        Get the dimensions of several texts rendered with the same font and size.
+        Returns a list of (width, height) tuples in the order of the texts.
+        """
+        if font_path is None:
+            font_path = FontUtils.get_current_font()
+        return [FontUtils._measure(font_path, font_size, text) for text in texts]
 
 
 if __name__ == "__main__":